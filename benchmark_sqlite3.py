@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Headless benchmarks of data_sqlite3.Model and View on synthetic histories.
+
+Builds one database per size in a temporary directory, times the public
+operations and prints the results as JSON, to compare before and after a
+change:
+
+    python benchmark_sqlite3.py --sizes 1000,100000 --output before.json
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+import datetime
+import argparse
+import timeit
+
+import data_sqlite3
+
+SIZES_DEFAULT = [1000, 100000, 1000000] # rows in move_latest
+FOLDERS_DEFAULT = 10000 # rows in target_folder
+SEED = 42
+
+def zipf_index(rng, n, s=1.1):
+    """Index in range(n), low ones much more likely: a few folders and
+    extensions get most of the moves, like in real use."""
+    while True:
+        i = int(rng.paretovariate(s)) - 1
+        if i < n:
+            return i
+
+def database_build(filepath, rows, folder_paths, seed=SEED,
+                   timestamps_epoch=False):
+    """Create a database with rows moves spread over folder_paths."""
+    rng = random.Random(seed)
+    model = data_sqlite3.Model(filepath, timestamps_epoch=timestamps_epoch)
+    folders = len(folder_paths)
+    now = datetime.datetime.now()
+
+    # move_latest is keyed on (filename_length, file_extension): spread the
+    # rows over enough extensions to get unique keys
+    lengths = 200
+    extensions = rows // lengths + 1
+
+    def moves_generate():
+        n = 0
+        for e in range(extensions):
+            for length in range(1, lengths + 1):
+                if n == rows:
+                    return
+                n += 1
+                yield (length, ".e%d" % e,
+                       folder_paths[zipf_index(rng, folders)],
+                       model.date_db(now - datetime.timedelta(
+                               seconds=rng.randint(0, 3 * 365 * 86400))),
+                       1 + zipf_index(rng, 1000))
+
+    with model.connection() as conn:
+        conn.executemany("""INSERT INTO target_folder
+            (folder_path, alive_checks_failed, flag_bookmark,
+             flag_explorer_open, flag_private, flag_retired)
+            VALUES(?, ?, ?, ?, ?, ?)""",
+            [(ff, 0, rng.random() < 0.01, rng.random() < 0.1,
+              rng.random() < 0.05, False) for ff in folder_paths])
+        conn.executemany("""INSERT INTO move_latest
+            (filename_length, file_extension, target_folder,
+             moved_latest_date, moved_times)
+            VALUES(?, ?, ?, ?, ?)""", moves_generate())
+    model.close()
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+def measure(function, repeat):
+    """Call function repeat times, return its timing summary.
+    function returns how many items it processed, for the throughput."""
+    latencies = []
+    items = 0
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        items += function() or 0
+        latencies.append(timeit.default_timer() - start)
+    latencies.sort()
+    total = sum(latencies)
+    return {'calls': repeat,
+            'items': items,
+            'total_s': total,
+            'calls_per_s': repeat / total if total else None,
+            'items_per_s': items / total if total else None,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000}
+
+def folders_create(directory, folders):
+    """Real folders, so that the alive check finds them and leaves the
+    data alone between runs."""
+    folder_paths = [os.path.join(directory, "folder%05d" % i)
+                    for i in range(folders)]
+    for ff in folder_paths:
+        if not os.path.isdir(ff):
+            os.makedirs(ff)
+    return folder_paths
+
+def benchmark_size(directory, rows, folders, repeat, burst,
+                   timestamps_epoch=False, memory=False):
+    filepath = os.path.join(directory, "bench_%d.db" % (rows,))
+    folder_paths = folders_create(directory, folders)
+    start = timeit.default_timer()
+    database_build(filepath, rows, folder_paths,
+                   timestamps_epoch=timestamps_epoch)
+    results = {'rows': rows, 'folders': folders,
+               'timestamps_epoch': timestamps_epoch,
+               'memory': memory,
+               'build_s': timeit.default_timer() - start}
+
+    def model_cold():
+        data_sqlite3.Model(filepath, memory=memory).close()
+    results['model_construct'] = measure(model_cold, max(1, repeat // 5))
+
+    model = data_sqlite3.Model(filepath, memory=memory)
+    view = data_sqlite3.View(model)
+    def alive_check():
+        model.folders_postload_exist_check()
+        return folders
+    results['folders_postload_exist_check'] = measure(alive_check,
+                                                      max(1, repeat // 5))
+
+    generators = [
+        ('bookmarks_generate', lambda: view.bookmarks_generate()),
+        ('all_generate', lambda: view.all_generate()),
+        ('by_extension_generate', lambda: view.by_extension_generate(".e0")),
+        ('by_extension_and_length_generate',
+         lambda: view.by_extension_and_length_generate(".e0", 10)),
+        ('suggest', lambda: view.suggest("x" * 10 + ".e0")),
+        # a filter box: a few matches, all folders, too short for the index
+        ('search', lambda: view.search("older0012")),
+        ('search_broad', lambda: view.search("older")),
+        ('search_short', lambda: view.search("r0")),
+        ]
+    for name, generate in generators:
+        results[name] = measure(lambda: len(list(generate())), repeat)
+
+    # a burst of moves into a few folders, timed per call
+    rng = random.Random(SEED)
+    def move():
+        model.statistics_update_post_move(
+                folder_paths[rng.randint(0, 9)],
+                "x" * rng.randint(1, 50) + ".e%d" % rng.randint(0, 9))
+        return 1
+    results['statistics_update_post_move'] = measure(move, burst)
+    model.write_behind = True
+    results['statistics_update_post_move_write_behind'] = measure(move, burst)
+    results['flush'] = measure(model.flush, 1)
+    if memory:
+        results['persist'] = measure(model.persist, 1)
+    model.close()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=",".join(map(str, SIZES_DEFAULT)),
+                        help="move_latest rows per database, comma separated")
+    parser.add_argument('--folders', type=int, default=FOLDERS_DEFAULT)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help="calls per view measurement")
+    parser.add_argument('--burst', type=int, default=1000,
+                        help="moves per statistics_update_post_move burst")
+    parser.add_argument('--timestamps-epoch', action='store_true',
+                        help="databases with integer move dates")
+    parser.add_argument('--memory', action='store_true',
+                        help="models working on an in-memory copy")
+    parser.add_argument('--output', help="JSON file, default stdout")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="benchmark_sqlite3_")
+    try:
+        report = {'sqlite_version': data_sqlite3.sqlite3.sqlite_version,
+                  'python_version': sys.version.split()[0],
+                  'sizes': [benchmark_size(directory, int(rows), args.folders,
+                                           args.repeat, args.burst,
+                                           args.timestamps_epoch,
+                                           args.memory)
+                            for rows in args.sizes.split(",")]}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,23 @@
 ﻿#!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from PySide import QtCore, QtGui
+# PySide is only imported by the interactive test functions: the data
+# layer has pure-Python stand-ins for the few QDir calls it needs, so that
+# CLI tools and worker processes do not pay for starting Qt.
 import os
 import sys
+import posixpath
+import collections
 
 import sqlite3
 import datetime
+import threading
+import time
+import Queue
+import heapq
+import types
+import atexit
+import weakref
 
 import logging
 
@@ -14,168 +25,1383 @@ import logging
 """
 
 FOLDERPATH_WHITESPACE_STRIP = True
+FOLDERPATH_NORMALIZE_CACHE_SIZE = 4096
+
+def path_clean(path):
+    '''Pure-Python QDir.cleanPath() of Qt 4: the native separator 
+    converted to "/", multiple "/" collapsed (except the leading "//" of 
+    UNC paths on Windows), "."s and ".."s resolved, trailing "/" dropped.'''
+    if not path:
+        return path
+    if os.sep != '/':
+        path = path.replace(os.sep, '/')
+    unc = os.name == 'nt' and path.startswith('//')
+    path = posixpath.normpath(path)
+    # normpath keeps exactly two leading slashes, cleanPath does not
+    if path.startswith('//'):
+        path = path[1:]
+    if unc:
+        path = '/' + path
+    return path
+
+def path_to_native_separators(path):
+    '''Pure-Python QDir.toNativeSeparators().'''
+    if os.sep != '/':
+        return path.replace('/', os.sep)
+    return path
+
+_folder_path_normalized = collections.OrderedDict()
+_folder_path_normalized_lock = threading.Lock()
 
 def folder_path_normalize(folder):
     '''directory separators normalized (converted to "/") and 
     redundant ones removed, and "."s and ".."s resolved (as far as possible).
-    Symbolic links are kept.  '''
-    path = QtCore.QDir.cleanPath(folder)
+    Symbolic links are kept.  
+    Always returns unicode, like QDir did: byte strings are decoded with
+    the file system encoding.
+    Remembers the last FOLDERPATH_NORMALIZE_CACHE_SIZE paths.'''
+    with _folder_path_normalized_lock:
+        path = _folder_path_normalized.pop(folder, None)
+        if path is not None:
+            # most recently used last
+            _folder_path_normalized[folder] = path
+            return path
+            
+    path = folder
+    if isinstance(path, str):
+        # sqlite3 refuses 8-bit byte strings, the log ascii-encodes paths
+        path = path.decode(sys.getfilesystemencoding() or 'utf-8', 
+                           'replace')
+    path = path_clean(path)
     if FOLDERPATH_WHITESPACE_STRIP == True:
         path = path.strip()
     ''' with the '/' separators converted to separators that are appropriate 
     for the underlying operating system.'''
-    return QtCore.QDir.toNativeSeparators(path)
+    path = path_to_native_separators(path)
     # there is also path = dir.canonicalPath()
     # but this would check existence, too
     
+    with _folder_path_normalized_lock:
+        _folder_path_normalized[folder] = path
+        if len(_folder_path_normalized) > FOLDERPATH_NORMALIZE_CACHE_SIZE:
+            _folder_path_normalized.popitem(last=False)
+    return path
+    
 def test_folder_path_normalize():
     print("BOL"+folder_path_normalize(r"C:\test\test\\// ")+"EOL")
 
+ALIVE_CHECK_THREADS = 8
+ALIVE_CHECK_TIMEOUT = 2.0 # seconds per folder
+
+def folders_exist_probe(folders, threads=ALIVE_CHECK_THREADS,
+                        timeout=ALIVE_CHECK_TIMEOUT):
+    '''Check which folders exist, several at a time on daemon threads.
+    Returns a dict folder -> bool.
+    A folder that does not answer within timeout seconds (dead network
+    mount) counts as not existing. Its thread is left behind, hanging,
+    and a fresh one takes over the remaining folders.  '''
+    results = {}
+    if not folders:
+        return results
+    pending = Queue.Queue()
+    for ff in folders:
+        pending.put(ff)
+    started = {}
+    done = threading.Condition()
+
+    def work():
+        while True:
+            try:
+                ff = pending.get_nowait()
+            except Queue.Empty:
+                return
+            with done:
+                started[ff] = time.time()
+            # what QDir(ff).exists() answers: an existing directory
+            ff_exists = os.path.isdir(ff)
+            with done:
+                if started.pop(ff, None) is not None:
+                    results[ff] = ff_exists
+                done.notify()
+
+    def thread_start():
+        thread = threading.Thread(target=work, name="folders_exist_probe")
+        thread.daemon = True
+        thread.start()
+
+    for _ in range(min(threads, len(folders))):
+        thread_start()
+
+    with done:
+        while len(results) < len(folders):
+            now = time.time()
+            deadline = now + timeout
+            for ff, ff_started in started.items():
+                if now - ff_started >= timeout:
+                    del started[ff]
+                    results[ff] = False
+                    ffe = ff.encode('ascii', 'backslashreplace')
+                    logging.info("DB: Folder check timed out: %s" % (ffe,))
+                    thread_start()
+                else:
+                    deadline = min(deadline, ff_started + timeout)
+            if len(results) < len(folders):
+                done.wait(max(deadline - now, 0.01))
+    return results
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
 # both target folderpath and file extension are normalized in this module!
 # extension '(none)' is generated in parent module
 # data_folders_flat, data_categories_tree therefore get clean references!
 
 DATABASE_FILE_EXTENSION_IS_LOWERCASE = True
+WRITE_BEHIND_MAX_MOVES = 500
+WRITE_BEHIND_MAX_SECONDS = 5.0
+# View.suggest(): weight of a move by how its filename length matches,
+# and after how many days its weight halves
+SUGGEST_WEIGHT_EXACT = 4.0
+SUGGEST_WEIGHT_LENGTH_NEAR = 2.0
+SUGGEST_LENGTH_NEAR = 2 # characters
+SUGGEST_WEIGHT_EXTENSION = 1.0
+SUGGEST_HALF_LIFE_DAYS = 30.0
+# View generators: rows read per query when they page by path, and the
+# orders they can be asked for (columns of View._folders_generate's queries)
+VIEW_FETCH_BATCH = 100
+VIEW_ORDER_BY = {'moved_times': "3 DESC, 1",
+                 'recency': "4 DESC, 1",
+                 'path': "1"}
+
+# Settings applied to every connection, in this order, by Model(profile=...).
+# "default" keeps the SQLite defaults (rollback journal).
+# "concurrent" lets several processes use the database at once: with WAL
+# readers do not block the writer and vice versa; synchronous=NORMAL is
+# still safe with WAL, it only skips the fsync per commit.
+DATABASE_PROFILES = {
+    'default': [],
+    'concurrent': [('busy_timeout', 5000), # ms
+                   ('journal_mode', 'WAL'),
+                   ('synchronous', 'NORMAL'),
+                   ('cache_size', -8000), # KiB
+                   ('mmap_size', 64 * 1024 * 1024)],
+    }
+# Writes that still find the database locked are tried again this often,
+# waiting LOCKED_RETRY_WAIT seconds, doubled after each attempt.
+LOCKED_RETRIES = 5
+LOCKED_RETRY_WAIT = 0.05
+
+def retry_on_locked(method):
+    """Decorator for Model methods that write in one transaction: 
+    run the method again, with backoff, if the database is locked."""
+    def wrapper(self, *args, **kwargs):
+        wait = LOCKED_RETRY_WAIT
+        for attempt in range(LOCKED_RETRIES + 1):
+            try:
+                return method(self, *args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                # a commit that failed leaves the transaction open in 
+                # Python 2: neither retry on top of it nor leave it behind
+                # for the next write to commit
+                self.connection().rollback()
+                if attempt == LOCKED_RETRIES:
+                    raise
+                logging.info("DB: %s, retrying %s in %.2fs" % 
+                             (e, method.__name__, wait))
+                time.sleep(wait)
+                wait *= 2
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+# Instrumentation, see Model(instrument=True)
+SLOW_STATEMENT_MS = 50.0 # logged as warning
+PROGRESS_HANDLER_STEPS = 1000 # SQLite VM instructions per progress call
+MODEL_TIMED_METHODS = ['schema_migrate', 'folders_postload_exist_check',
+                       'bookmark_add', 'bookmark_add_many', 'bookmark_remove',
+                       'folder_remove', 'folder_flag_set', 'folder_flag_get',
+                       'statistics_update_post_move',
+                       'statistics_update_post_move_many', 'flush',
+                       'maintenance']
+VIEW_TIMED_METHODS = ['bookmarks_generate', 'all_generate',
+                      'by_extension_generate',
+                      'by_extension_and_length_generate', 'suggest',
+                      'search']
+
+class Instrumentation(object):
+    """Counts, total and max durations and rows returned, per SQL statement
+    and per timed Model/View method. Shared by all connections of a model.
+    """
+    def __init__(self, slow_ms=SLOW_STATEMENT_MS):
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._statements = {}
+            self._methods = {}
+
+    def stats(self):
+        """Snapshot: {'statements': {sql: entry}, 'methods': {name: entry}},
+        entries being dicts of count, total_ms, max_ms, rows (and vm_steps,
+        in thousands of SQLite VM instructions, for statements)."""
+        with self._lock:
+            return {'statements': dict((key, dict(entry)) for key, entry
+                                       in self._statements.items()),
+                    'methods': dict((key, dict(entry)) for key, entry
+                                    in self._methods.items())}
+
+    def _record(self, table, key, seconds, rows, count=1, vm_steps=0):
+        ms = seconds * 1000
+        with self._lock:
+            entry = table.get(key)
+            if entry is None:
+                entry = table[key] = {'count': 0, 'total_ms': 0.0,
+                                      'max_ms': 0.0, 'rows': 0}
+            entry['count'] += count
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            entry['rows'] += rows
+            if table is self._statements:
+                entry['vm_steps'] = entry.get('vm_steps', 0) + vm_steps
+
+    def statement_record(self, sql, seconds, rows=0, count=1, vm_steps=0):
+        key = " ".join(sql.split())
+        self._record(self._statements, key, seconds, rows, count, vm_steps)
+        if count and seconds * 1000 >= self.slow_ms:
+            logging.warning("DB: Slow statement, %.1f ms: %s" %
+                            (seconds * 1000, key))
+
+    def method_timed(self, name, method):
+        """Wrap a bound method to record its wall-clock time. A generator it
+        returns is timed until exhausted, counting the rows it yields."""
+        def timed(*args, **kwargs):
+            start = time.time()
+            result = method(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                return self._generator_timed(name, result, start)
+            rows = len(result) if isinstance(result, list) else 0
+            self._record(self._methods, name, time.time() - start, rows)
+            return result
+        timed.__name__ = method.__name__
+        timed.__doc__ = method.__doc__
+        return timed
+
+    def _generator_timed(self, name, generator, start):
+        rows = 0
+        try:
+            for row in generator:
+                rows += 1
+                yield row
+        finally:
+            self._record(self._methods, name, time.time() - start, rows)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Reports every statement, and the rows fetched from it, to the
+    Instrumentation of its connection."""
+    def _statement_run(self, method, sql, parameters):
+        conn = self.connection
+        self._sql = sql
+        steps = conn.vm_steps
+        start = time.time()
+        try:
+            return method(self, sql, parameters)
+        finally:
+            conn.instrumentation.statement_record(
+                    sql, time.time() - start,
+                    vm_steps=conn.vm_steps - steps)
+
+    def execute(self, sql, parameters=()):
+        return self._statement_run(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._statement_run(sqlite3.Cursor.executemany, sql, parameters)
+
+    def _rows_fetched(self, method, *args):
+        conn = self.connection
+        steps = conn.vm_steps
+        start = time.time()
+        rows = method(self, *args)
+        fetched = len(rows) if isinstance(rows, list) else int(rows is not None)
+        if getattr(self, '_sql', None) is not None:
+            # added to the statement, not counted as another call of it
+            conn.instrumentation.statement_record(
+                    self._sql, time.time() - start, fetched, count=0,
+                    vm_steps=conn.vm_steps - steps)
+        return rows
+
+    def fetchone(self):
+        return self._rows_fetched(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._rows_fetched(sqlite3.Cursor.fetchmany)
+        return self._rows_fetched(sqlite3.Cursor.fetchmany, size)
+
+    def fetchall(self):
+        return self._rows_fetched(sqlite3.Cursor.fetchall)
+
+    def next(self):
+        return self._rows_fetched(sqlite3.Cursor.next)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection factory for instrumented models. The Python 2 sqlite3
+    module has no set_trace_callback, so statements are caught in the
+    cursors, which execute() and executemany() of the connection use, too.
+    The progress handler counts the SQLite VM instructions spent.
+    """
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.instrumentation = None
+        self.vm_steps = 0
+        self.set_progress_handler(self._progress, PROGRESS_HANDLER_STEPS)
+
+    def _progress(self):
+        self.vm_steps += 1
+        return 0
+
+    def cursor(self, factory=InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+class SharedConnection(object):
+    """The one connection of a Model(memory=True), used by all threads:
+    a :memory: database exists only in the connection that opened it.
+    "with" holds its lock for the transaction, so that threads do not 
+    commit or roll back each other's work, and so does rollback(); 
+    everything else is passed on to the connection.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.RLock()
+        
+    def __enter__(self):
+        self.lock.acquire()
+        return self.conn.__enter__()
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.conn.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.lock.release()
+            
+    def rollback(self):
+        with self.lock:
+            self.conn.rollback()
+            
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+# Model(memory=True) writes the database back at least this often while
+# it changes. Needs VACUUM INTO: the sqlite3 module of Python 2 has no
+# backup API.
+MEMORY_PERSIST_SECONDS = 60.0
+MEMORY_SQLITE_VERSION = (3, 27, 0)
+# Where persist() puts the copy instead if the file changed under it
+MEMORY_CONFLICT_SUFFIX = ".memory"
+
 DATABASE_VERSION_MINIMUM = 3
-DATABASE_VERSION_CURRENT = 3
+DATABASE_VERSION_CURRENT = 5
+# From this version on moved_latest_date is INTEGER microseconds since the
+# epoch instead of a timestamp text; opt-in, see Model(timestamps_epoch=...)
+DATABASE_VERSION_EPOCH = 5
+
+# Schema upgrades, stored in "pragma user_version".
+# Key is the version a database is at after the step, steps are applied in
+# order by Model.schema_migrate(), each step in one transaction.
+DATABASE_MIGRATIONS = {
+    # The views and folder_remove() filter move_latest by target_folder,
+    # predictions by extension and length: avoid full table scans.
+    # The partial indexes serve the flag filters of the views; they are only
+    # used if the queries compare the flags to literals, not to parameters.
+    4: ["""CREATE INDEX IF NOT EXISTS move_latest_target_folder
+            ON move_latest(target_folder)""",
+        """CREATE INDEX IF NOT EXISTS move_latest_extension_length_folder
+            ON move_latest(file_extension, filename_length, target_folder)""",
+        """CREATE INDEX IF NOT EXISTS target_folder_bookmarks
+            ON target_folder(folder_path)
+            WHERE flag_bookmark=1 AND flag_retired=0""",
+        """CREATE INDEX IF NOT EXISTS target_folder_active
+            ON target_folder(flag_private, folder_path)
+            WHERE flag_retired=0"""],
+    # Timestamps as integers: no text parsing per row, and MAX() is numeric.
+    # The column type cannot be altered, so the table is copied; the text
+    # is local time, with or without ".ffffff".
+    5: ["""CREATE TABLE move_latest_epoch (
+            filename_length INTEGER,
+            file_extension TEXT,
+            target_folder TEXT,
+            moved_latest_date INTEGER,
+            moved_times INTEGER,
+            PRIMARY KEY(filename_length,file_extension))""",
+        """INSERT INTO move_latest_epoch
+            SELECT filename_length, file_extension, target_folder,
+                CAST(strftime('%s', substr(moved_latest_date, 1, 19), 'utc')
+                     AS INTEGER) * 1000000 +
+                CAST(substr(moved_latest_date || '.000000', 21, 6)
+                     AS INTEGER),
+                moved_times
+            FROM move_latest""",
+        """DROP TABLE move_latest""",
+        """ALTER TABLE move_latest_epoch RENAME TO move_latest""",
+        """CREATE INDEX move_latest_target_folder
+            ON move_latest(target_folder)""",
+        """CREATE INDEX move_latest_extension_length_folder
+            ON move_latest(file_extension, filename_length, target_folder)"""],
+    }
+
+# Sums of move_latest per folder (file_extension '', which move_latest 
+# never holds, see "(none)") and per folder and extension, kept current by
+# triggers, so that the views need not aggregate.
+# Not a user_version step: migration 5 recreates move_latest, which drops
+# its triggers, so Model.schema_extras_ensure() checks for them on startup.
+# moved_latest_date has no type: it holds whatever move_latest holds.
+FOLDER_STATS_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS folder_stats (
+        target_folder TEXT,
+        file_extension TEXT,
+        moved_times INTEGER,
+        moved_latest_date,
+        PRIMARY KEY(target_folder, file_extension))""",
+    """CREATE INDEX IF NOT EXISTS folder_stats_extension
+        ON folder_stats(file_extension, target_folder)""",
+    """CREATE TRIGGER IF NOT EXISTS move_latest_stats_insert
+        AFTER INSERT ON move_latest
+    BEGIN
+        INSERT OR IGNORE INTO folder_stats
+            VALUES(NEW.target_folder, '', 0, NULL);
+        INSERT OR IGNORE INTO folder_stats
+            VALUES(NEW.target_folder, NEW.file_extension, 0, NULL);
+        UPDATE folder_stats
+            SET moved_times = moved_times + NEW.moved_times,
+                moved_latest_date = CASE
+                    WHEN moved_latest_date IS NULL OR
+                         NEW.moved_latest_date > moved_latest_date
+                    THEN NEW.moved_latest_date
+                    ELSE moved_latest_date END
+            WHERE target_folder = NEW.target_folder AND
+                file_extension IN ('', NEW.file_extension);
+    END""",
+    # The usual update, a move: same row, count up, date not earlier
+    """CREATE TRIGGER IF NOT EXISTS move_latest_stats_update_move
+        AFTER UPDATE ON move_latest
+        WHEN OLD.target_folder IS NEW.target_folder AND
+            OLD.file_extension IS NEW.file_extension AND
+            (OLD.moved_latest_date IS NULL OR
+             COALESCE(NEW.moved_latest_date >= OLD.moved_latest_date, 0))
+    BEGIN
+        UPDATE folder_stats
+            SET moved_times = moved_times + NEW.moved_times - OLD.moved_times,
+                moved_latest_date = CASE
+                    WHEN moved_latest_date IS NULL OR
+                         NEW.moved_latest_date > moved_latest_date
+                    THEN NEW.moved_latest_date
+                    ELSE moved_latest_date END
+            WHERE target_folder = NEW.target_folder AND
+                file_extension IN ('', NEW.file_extension);
+    END""",
+    # Any other update: take OLD out and recount the dates, put NEW in
+    """CREATE TRIGGER IF NOT EXISTS move_latest_stats_update_other
+        AFTER UPDATE ON move_latest
+        WHEN NOT (OLD.target_folder IS NEW.target_folder AND
+            OLD.file_extension IS NEW.file_extension AND
+            (OLD.moved_latest_date IS NULL OR
+             COALESCE(NEW.moved_latest_date >= OLD.moved_latest_date, 0)))
+    BEGIN
+        UPDATE folder_stats
+            SET moved_times = moved_times - OLD.moved_times,
+                moved_latest_date = (SELECT MAX(m.moved_latest_date)
+                    FROM move_latest AS m
+                    WHERE m.target_folder = OLD.target_folder AND
+                        (folder_stats.file_extension = '' OR
+                         m.file_extension = OLD.file_extension))
+            WHERE target_folder = OLD.target_folder AND
+                file_extension IN ('', OLD.file_extension);
+        DELETE FROM folder_stats
+            WHERE target_folder = OLD.target_folder AND
+                file_extension IN ('', OLD.file_extension) AND
+                NOT EXISTS (SELECT 1 FROM move_latest AS m
+                    WHERE m.target_folder = OLD.target_folder AND
+                        (folder_stats.file_extension = '' OR
+                         m.file_extension = OLD.file_extension));
+        INSERT OR IGNORE INTO folder_stats
+            VALUES(NEW.target_folder, '', 0, NULL);
+        INSERT OR IGNORE INTO folder_stats
+            VALUES(NEW.target_folder, NEW.file_extension, 0, NULL);
+        UPDATE folder_stats
+            SET moved_times = moved_times + NEW.moved_times,
+                moved_latest_date = CASE
+                    WHEN moved_latest_date IS NULL OR
+                         NEW.moved_latest_date > moved_latest_date
+                    THEN NEW.moved_latest_date
+                    ELSE moved_latest_date END
+            WHERE target_folder = NEW.target_folder AND
+                file_extension IN ('', NEW.file_extension);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS move_latest_stats_delete
+        AFTER DELETE ON move_latest
+    BEGIN
+        UPDATE folder_stats
+            SET moved_times = moved_times - OLD.moved_times,
+                moved_latest_date = (SELECT MAX(m.moved_latest_date)
+                    FROM move_latest AS m
+                    WHERE m.target_folder = OLD.target_folder AND
+                        (folder_stats.file_extension = '' OR
+                         m.file_extension = OLD.file_extension))
+            WHERE target_folder = OLD.target_folder AND
+                file_extension IN ('', OLD.file_extension);
+        DELETE FROM folder_stats
+            WHERE target_folder = OLD.target_folder AND
+                file_extension IN ('', OLD.file_extension) AND
+                NOT EXISTS (SELECT 1 FROM move_latest AS m
+                    WHERE m.target_folder = OLD.target_folder AND
+                        (folder_stats.file_extension = '' OR
+                         m.file_extension = OLD.file_extension));
+    END""",
+    ]
+# %s: a WHERE clause on move_latest to count part of it, or ''
+FOLDER_STATS_COUNT = [
+    """INSERT INTO folder_stats
+        SELECT target_folder, '', SUM(moved_times), MAX(moved_latest_date)
+        FROM move_latest %s GROUP BY target_folder""",
+    """INSERT INTO folder_stats
+        SELECT target_folder, file_extension, SUM(moved_times),
+            MAX(moved_latest_date)
+        FROM move_latest %s GROUP BY target_folder, file_extension""",
+    ]
+FOLDER_STATS_REBUILD = (["""DELETE FROM folder_stats"""] + 
+                        [statement % ('',) for statement in FOLDER_STATS_COUNT])
+
+# When folders were retired, for Model.maintenance(). julianday, so that it
+# does not depend on how move_latest stores dates. Folders retired before
+# the table existed count as retired from when it was created.
+FOLDER_RETIRED_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS folder_retired (
+        folder_path TEXT PRIMARY KEY,
+        retired_date REAL)""",
+    """CREATE TRIGGER IF NOT EXISTS target_folder_retired_update
+        AFTER UPDATE OF flag_retired ON target_folder
+    BEGIN
+        INSERT OR IGNORE INTO folder_retired
+            SELECT NEW.folder_path, julianday('now') 
+            WHERE NEW.flag_retired=1;
+        DELETE FROM folder_retired
+            WHERE folder_path = NEW.folder_path AND NEW.flag_retired=0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS target_folder_retired_delete
+        AFTER DELETE ON target_folder
+    BEGIN
+        DELETE FROM folder_retired WHERE folder_path = OLD.folder_path;
+    END""",
+    """INSERT OR IGNORE INTO folder_retired
+        SELECT folder_path, julianday('now') FROM target_folder
+        WHERE flag_retired=1""",
+    ]
+
+# Trigram index of the folder paths for View.search(), kept in sync with 
+# target_folder. The paths get stable ids in folder_search_path, which is
+# the content of the index: VACUUM may renumber the rowids of target_folder.
+# Needs FTS5 with the trigram tokenizer (SQLite 3.34), else search() scans.
+FOLDER_SEARCH_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS folder_search_path (
+        id INTEGER PRIMARY KEY,
+        folder_path TEXT UNIQUE)""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS folder_search USING fts5(
+        folder_path, content='folder_search_path', content_rowid='id',
+        tokenize='trigram')""",
+    # left behind while the index was unavailable
+    """DELETE FROM folder_search_path WHERE folder_path NOT IN 
+        (SELECT folder_path FROM target_folder)""",
+    """INSERT OR IGNORE INTO folder_search_path(folder_path)
+        SELECT folder_path FROM target_folder""",
+    """INSERT INTO folder_search(folder_search) VALUES('rebuild')""",
+    """CREATE TRIGGER IF NOT EXISTS folder_search_path_insert
+        AFTER INSERT ON folder_search_path
+    BEGIN
+        INSERT INTO folder_search(rowid, folder_path)
+            VALUES(NEW.id, NEW.folder_path);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS folder_search_path_delete
+        AFTER DELETE ON folder_search_path
+    BEGIN
+        INSERT INTO folder_search(folder_search, rowid, folder_path)
+            VALUES('delete', OLD.id, OLD.folder_path);
+    END""",
+    # folder_path is the primary key of target_folder, it is never updated
+    """CREATE TRIGGER IF NOT EXISTS target_folder_search_insert
+        AFTER INSERT ON target_folder
+    BEGIN
+        INSERT OR IGNORE INTO folder_search_path(folder_path)
+            VALUES(NEW.folder_path);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS target_folder_search_delete
+        AFTER DELETE ON target_folder
+    BEGIN
+        DELETE FROM folder_search_path WHERE folder_path = OLD.folder_path;
+    END""",
+    ]
+
+# Model.maintenance() finds stale moves (few times, long ago) and the
+# oldest ones by these indexes, not by a full scan per chunk. Not a 
+# user_version step either, migration 5 would drop them with move_latest.
+MAINTENANCE_SCHEMA = [
+    """CREATE INDEX IF NOT EXISTS move_latest_times_date
+        ON move_latest(moved_times, moved_latest_date)""",
+    """CREATE INDEX IF NOT EXISTS move_latest_date
+        ON move_latest(moved_latest_date)""",
+    ]
 
+# Tables outside of the versioned schema: a trigger or index that shows 
+# they exist, the statements that create and fill them, and whether they
+# may be missing (the SQLite in use cannot create them).
+SCHEMA_EXTRAS = [
+    ('move_latest_stats_insert', FOLDER_STATS_SCHEMA + FOLDER_STATS_REBUILD,
+     False),
+    ('target_folder_retired_update', FOLDER_RETIRED_SCHEMA, False),
+    ('target_folder_search_delete', FOLDER_SEARCH_SCHEMA, True),
+    ('move_latest_times_date', MAINTENANCE_SCHEMA, False),
+    ]
+
+# Model.maintenance(): retention rules and the size of its slices.
+# History of folders retired longer than MAINTENANCE_RETIRED_DAYS is purged,
+# moves not repeated for MAINTENANCE_STALE_DAYS and made at most 
+# MAINTENANCE_STALE_TIMES times are dropped, and beyond MAINTENANCE_MAX_MOVES
+# rows (None: no limit) the oldest go.
+MAINTENANCE_RETIRED_DAYS = 180
+MAINTENANCE_STALE_DAYS = 730
+MAINTENANCE_STALE_TIMES = 1
+MAINTENANCE_MAX_MOVES = None
+MAINTENANCE_BUDGET_SECONDS = 0.05 # per call
+MAINTENANCE_CHUNK_ROWS = 200 # rows deleted per transaction
+MAINTENANCE_VACUUM_PAGES = 64 # pages given back per incremental vacuum step
+
+
+def _model_exit_write(model_ref):
+    """atexit hook of a Model with write_behind or memory: their timers
+    are daemon threads, what they would write is lost with the process 
+    if it ends without close()."""
+    model = model_ref()
+    if model is None:
+        return
+    try:
+        if not model.memory:
+            model.flush()
+        elif model._memory_conn is not None:
+            # not after close(), persist() would load the file anew
+            model.persist()
+    except Exception:
+        logging.exception("DB: Writing on exit failed")
 
 class Model:
-    def __init__(self, database_filepath="loadstar_sqlite3.db"):
+    def __init__(self, database_filepath="loadstar_sqlite3.db",
+                 alive_check_background=False, alive_check_done=None,
+                 write_behind=False, profile='default', instrument=False,
+                 timestamps_epoch=False, memory=False):
         """ Is called once in 
+        With alive_check_background the folder alive check runs on a worker
+        thread and the model is usable right away, with the data as it was
+        before the check. alive_check_done(retired_folders) is then called
+        from the worker thread once the check is written back, with [] if
+        it failed (logged); Qt callers can pass a Signal's emit to get it
+        queued to the GUI thread.
+        With write_behind statistics_update_post_move() only buffers moves,
+        merged per folder, extension and length. They are written in one
+        transaction by flush(), at the latest after WRITE_BEHIND_MAX_MOVES
+        moves or WRITE_BEHIND_MAX_SECONDS, before views read, on close() 
+        and when the process exits.
+        profile is a key of DATABASE_PROFILES or a list of (pragma, value).
+        With instrument (True, or an Instrumentation to share) every
+        statement and the MODEL_TIMED_METHODS/VIEW_TIMED_METHODS are timed,
+        see stats(); statements slower than SLOW_STATEMENT_MS are logged.
+        With timestamps_epoch the schema is migrated to 
+        DATABASE_VERSION_EPOCH, which stores move dates as integers. 
+        A database already migrated stays so, with or without the option.
+        With memory the database is copied into RAM (:memory:) when first
+        used and all threads share that one connection. It is written back
+        to database_filepath by persist(): every MEMORY_PERSIST_SECONDS 
+        while it changes, on close() and when the process exits. 
+        database_filepath None keeps it in RAM only, a fresh one for tests
+        and benchmarks.
+        Memory mode needs the file to itself: other processes must not 
+        open it meanwhile, their writes would be lost. persist() does not
+        overwrite a file that changed since it was loaded, see there.
         """
         self.database_filepath = database_filepath
+        if isinstance(profile, basestring):
+            profile = DATABASE_PROFILES[profile]
+        self.pragmas = list(profile)
+        self.alive_check_done = alive_check_done
+        self.alive_check_thread = None
         
         sqlite3.register_adapter(bool, int)
         sqlite3.register_converter("BOOLEAN", lambda v: bool(int(v)))
 
         
+        # Write transactions start with BEGIN IMMEDIATE: a locked database
+        # shows at their first statement, not at the commit
         self.connect_args = {'database':self.database_filepath,
-                             'detect_types':sqlite3.PARSE_DECLTYPES}
+                             'detect_types':sqlite3.PARSE_DECLTYPES,
+                             'isolation_level':'IMMEDIATE'}
+        
+        # In-memory working copy, see connection()
+        self.memory = memory
+        if memory:
+            if sqlite3.sqlite_version_info < MEMORY_SQLITE_VERSION:
+                raise ValueError("DB: memory needs SQLite %d.%d.%d, "
+                                 "this is %s" % (MEMORY_SQLITE_VERSION + 
+                                 (sqlite3.sqlite_version,)))
+            self.connect_args['database'] = ':memory:'
+        self._memory_conn = None
+        self._memory_persisted = None
+        self._memory_file = None
+        self._memory_timer = None
+        self._memory_persist_lock = threading.Lock()
+        
+        # Long-lived connections, one per thread, shared with View.
+        # Opened lazily by connection(), all closed by close(); those of
+        # threads that ended when the next one is opened.
+        # [(thread or None for memory, connection)]
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        
+        # Write-behind buffer: (folder, extension, length) -> 
+        # (times moved, latest move date)
+        self.write_behind = write_behind
+        self._moves_pending = {}
+        self._moves_pending_count = 0
+        self._moves_lock = threading.RLock()
+        self._moves_timer = None
+        if write_behind or (memory and database_filepath is not None):
+            atexit.register(_model_exit_write, weakref.ref(self))
+        
+        # The step maintenance() goes on with
+        self._maintenance_step = 0
+        
+        # Opt-in instrumentation: wrap the timed methods of this instance
+        # only, so that an uninstrumented model pays nothing for it
+        if instrument is True:
+            instrument = Instrumentation()
+        self.instrumentation = instrument or None
+        if self.instrumentation is not None:
+            self.connect_args['factory'] = InstrumentedConnection
+            for name in MODEL_TIMED_METHODS:
+                setattr(self, name, self.instrumentation.method_timed(
+                        name, getattr(self, name)))
+        
+        # Read-through cache of target_folder: folder_path -> row dict,
+        # None until first used. Kept in sync by the write methods.
+        self._folders_cache = None
+        self._folders_lock = threading.Lock()
+        
+        # Read-through cache of the moves View.suggest() weighs: 
+        # extension -> list, see _suggest_moves(). The writes drop what
+        # they change, a read that a write overtook is not kept.
+        self._suggest_cache = {}
+        self._suggest_generation = 0
+        self._suggest_lock = threading.Lock()
 
-        self.initial_run = not os.path.exists(database_filepath)
+        self.initial_run = (database_filepath is None or 
+                            not os.path.exists(database_filepath))
+        self._auto_vacuum_new = False
+        
+        schema_target = DATABASE_VERSION_CURRENT
+        if not timestamps_epoch:
+            schema_target = DATABASE_VERSION_EPOCH - 1
+        self.timestamps_epoch = False # set by schema_migrate()
+        self.search_indexed = False # set by schema_extras_ensure()
         
         if self.initial_run:
             logging.info('DB: Creating schema')
-            with sqlite3.connect(**self.connect_args) as conn:
-                """ Alternative:
-                cursor.execute('''CREATE TABLE IF NOT EXISTS
-                    users(id INTEGER PRIMARY KEY, name TEXT, phone TEXT, email TEXT unique, password TEXT)''')
-                """
-                schema = """
-                CREATE TABLE `target_folder` (
-                    `folder_path`	TEXT,
-                    `alive_checks_failed`	INTEGER,
-                    `flag_bookmark`	BOOLEAN,
-                    `flag_explorer_open`	BOOLEAN,
-                    `flag_private`	BOOLEAN,
-                    `flag_retired`	BOOLEAN,
-                    PRIMARY KEY(folder_path)
-                );
-                CREATE TABLE `move_latest` (
-                    `filename_length`	INTEGER,
-                    `file_extension`	TEXT,
-                    `target_folder`	TEXT,
-                    `moved_latest_date`	timestamp,
-                    `moved_times`	INTEGER,
-                    PRIMARY KEY(filename_length,file_extension)
-                );
-                """
-                conn.executescript(schema)
-            
+            """ Alternative:
+            cursor.execute('''CREATE TABLE IF NOT EXISTS
+                users(id INTEGER PRIMARY KEY, name TEXT, phone TEXT, email TEXT unique, password TEXT)''')
+            """
+            schema = """
+            CREATE TABLE `target_folder` (
+                `folder_path`	TEXT,
+                `alive_checks_failed`	INTEGER,
+                `flag_bookmark`	BOOLEAN,
+                `flag_explorer_open`	BOOLEAN,
+                `flag_private`	BOOLEAN,
+                `flag_retired`	BOOLEAN,
+                PRIMARY KEY(folder_path)
+            );
+            CREATE TABLE `move_latest` (
+                `filename_length`	INTEGER,
+                `file_extension`	TEXT,
+                `target_folder`	TEXT,
+                `moved_latest_date`	timestamp,
+                `moved_times`	INTEGER,
+                PRIMARY KEY(filename_length,file_extension)
+            );
+            """
+            # auto_vacuum by the first connection, see _connect()
+            self._auto_vacuum_new = True
+            try:
+                self.connection()
+            finally:
+                self._auto_vacuum_new = False
+            # another process may have created the file meanwhile
+            self._script_run([statement for statement in schema.split(";")
+                              if statement.strip()] + 
+                             ["PRAGMA user_version = %d" % 
+                              (DATABASE_VERSION_MINIMUM,)],
+                             applied=lambda conn: conn.execute(
+                                 """SELECT count(*) FROM sqlite_master 
+                                 WHERE name='move_latest'""").fetchone()[0])
+            self.schema_migrate(schema_target)
+            self.schema_extras_ensure()
+
         else:
             logging.info('DB: file exists, assume schema does, too.')
-            self.folders_postload_exist_check()
-         
+            self.schema_migrate(schema_target)
+            self.schema_extras_ensure()
+            if alive_check_background:
+                self.alive_check_thread = threading.Thread(
+                        target=self._alive_check_run, name="alive_check")
+                self.alive_check_thread.daemon = True
+                self.alive_check_thread.start()
+            else:
+                self.folders_postload_exist_check()
+
             #logging.debug("Folders post-load normalization and sanitization:")
             #data_folders_flat.folders_postload_normalize_sanitize(self.folders_flat_dict)
 
-        # TODO check version with pragma user_version
+    def schema_migrate(self, target=DATABASE_VERSION_CURRENT):
+        """Bring the schema to version target in place, one step of 
+        DATABASE_MIGRATIONS after the other, each in one transaction.
+        Databases from before versioning report user_version 0 and
+        are taken as DATABASE_VERSION_MINIMUM.
+        """
+        with self.connection() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            version = DATABASE_VERSION_MINIMUM
+        if version < DATABASE_VERSION_MINIMUM:
+            raise ValueError("DB: schema version %d of %s is too old, "
+                             "minimum is %d" % (version,
+                             self.database_filepath, DATABASE_VERSION_MINIMUM))
+        if version > DATABASE_VERSION_CURRENT:
+            logging.warning("DB: schema version %d is newer than %d, "
+                            "leaving it alone" % (version,
+                                                  DATABASE_VERSION_CURRENT))
+
+        def step_applied(conn, step):
+            # by another process since the version was read
+            return conn.execute("PRAGMA user_version").fetchone()[0] >= step
+            
+        for step in range(version + 1, target + 1):
+            logging.info('DB: Migrating schema to version %d' % (step,))
+            if not self._script_run(DATABASE_MIGRATIONS[step] + 
+                                    ["PRAGMA user_version = %d" % (step,)],
+                                    applied=lambda conn: step_applied(conn, 
+                                                                      step)):
+                logging.info('DB: Version %d was migrated to meanwhile' % 
+                             (step,))
+        with self.connection() as conn:
+            self._timestamps_epoch_refresh(conn)
+        
+    def _timestamps_epoch_refresh(self, conn):
+        """Set timestamps_epoch from the version of the file: another 
+        process may have migrated it to DATABASE_VERSION_EPOCH since.
+        Writers call it in their transaction, before converting dates."""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        timestamps_epoch = version >= DATABASE_VERSION_EPOCH
+        if timestamps_epoch != self.timestamps_epoch:
+            self.timestamps_epoch = timestamps_epoch
+            # cached dates are in the old format
+            self._suggest_cache_drop()
+        
+    def schema_extras_ensure(self):
+        """Create the SCHEMA_EXTRAS that are missing, each filled from 
+        the data in one transaction. Sets search_indexed."""
+        with self.connection() as conn:
+            found = set(row[0] for row in conn.execute("""SELECT name 
+                FROM sqlite_master WHERE type IN ('trigger', 'index')"""))
+            if 'target_folder_search_delete' in found:
+                try:
+                    conn.execute("SELECT 1 FROM folder_search LIMIT 0")
+                except sqlite3.OperationalError as e:
+                    # created by a newer SQLite: unhook it, or every
+                    # insert into target_folder would fail
+                    logging.warning("DB: folder_search unusable, "
+                                    "dropped its triggers: %s" % (e,))
+                    self._script_run(["DROP TRIGGER target_folder_search_insert",
+                                      "DROP TRIGGER target_folder_search_delete"])
+                    found.discard('target_folder_search_delete')
+        for trigger, statements, optional in SCHEMA_EXTRAS:
+            if trigger in found:
+                continue
+            logging.info('DB: Creating %s' % (trigger,))
+            try:
+                self._script_run(statements, 
+                                 applied=lambda conn: conn.execute(
+                                     """SELECT count(*) FROM sqlite_master 
+                                     WHERE type IN ('trigger', 'index') 
+                                     AND name=?""",
+                                     (trigger,)).fetchone()[0])
+            except sqlite3.OperationalError as e:
+                if not optional:
+                    raise
+                logging.info("DB: Not available: %s" % (e,))
+                continue
+            found.add(trigger)
+        self.search_indexed = 'target_folder_search_delete' in found
+        
+    @retry_on_locked
+    def folder_stats_rebuild(self):
+        """Recount folder_stats from move_latest, e.g. after move_latest
+        was changed with the triggers missing (older versions, other 
+        tools)."""
+        self.flush()
+        self._script_run(FOLDER_STATS_SCHEMA + FOLDER_STATS_REBUILD)
+        
+    def _script_run(self, statements, applied=None):
+        """Run statements in one transaction that holds the write lock 
+        from the start (BEGIN IMMEDIATE), so that other processes wait.
+        applied(conn), if given, is asked first, inside the transaction:
+        if it returns true the statements were run by someone else 
+        meanwhile and are skipped. Returns whether they ran."""
+        with self.connection() as conn:
+            # transaction by hand: the sqlite3 module would commit before DDL
+            isolation_level = conn.isolation_level
+            conn.isolation_level = None
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if applied is not None and applied(conn):
+                        conn.execute("ROLLBACK")
+                        return False
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute("COMMIT")
+                except Exception:
+                    try:
+                        conn.execute("ROLLBACK")
+                    except sqlite3.OperationalError:
+                        pass
+                    raise
+            finally:
+                conn.isolation_level = isolation_level
+        return True
+        
+    def date_db(self, date):
+        """A datetime as moved_latest_date stores it."""
+        if self.timestamps_epoch:
+            return (int(time.mktime(date.timetuple())) * 1000000 + 
+                    date.microsecond)
+        return date
+        
+    def date_sql(self, expression):
+        """SQL for a moved_latest_date expression as local time text 
+        'YYYY-MM-DD HH:MM:SS', formatted by SQLite, not per row in Python."""
+        if self.timestamps_epoch:
+            return ("strftime('%%Y-%%m-%%d %%H:%%M:%%S', (%s) / 1000000, "
+                    "'unixepoch', 'localtime')" % (expression,))
+        return "substr(%s, 1, 19)" % (expression,)
+        
+    def age_days_sql(self, expression):
+        """SQL for the days passed since a moved_latest_date expression."""
+        if self.timestamps_epoch:
+            return ("(strftime('%%s', 'now') * 1000000 - (%s)) / 86400e6" % 
+                    (expression,))
+        return ("julianday('now', 'localtime') - julianday(%s)" % 
+                (expression,))
+
+    def connection(self):
+        """Return the long-lived connection of the calling thread, 
+        opening it on first use. 
+        Use as "with model.connection() as conn:" to get a transaction 
+        that commits on success and rolls back on error, like a fresh 
+        sqlite3.connect() did before, minus the open/close cost.
+        With memory it is the SharedConnection of all threads.
+        Opening one closes those of threads that have ended.
+        """
+        if self.memory:
+            return self._memory_connection()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            with self._connections_lock:
+                ended = [(thread, old) for thread, old in self._connections 
+                         if thread is not None and not thread.is_alive()]
+                self._connections = [entry for entry in self._connections
+                                     if entry not in ended]
+                self._connections.append((threading.current_thread(), conn))
+            for thread, old in ended:
+                old.close()
+            self._local.conn = conn
+        return conn
+        
+    def _connect(self):
+        # check_same_thread off only so that close() and connection() may
+        # close connections of other threads; each thread still uses its own
+        conn = sqlite3.connect(check_same_thread=False, **self.connect_args)
+        if self.instrumentation is not None:
+            conn.instrumentation = self.instrumentation
+        if self._auto_vacuum_new:
+            # before the first table, later it takes a VACUUM; before the
+            # profile, journal_mode=WAL writes the file header; not in a
+            # transaction, it would not take effect there
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        for pragma, value in self.pragmas:
+            conn.execute("PRAGMA %s = %s" % (pragma, value)).fetchall()
+        return conn
+        
+    def _memory_connection(self):
+        with self._connections_lock:
+            if self._memory_conn is None:
+                conn = self._connect()
+                if (self.database_filepath is not None and 
+                    os.path.exists(self.database_filepath)):
+                    self._memory_load(conn)
+                self._connections.append((None, conn))
+                self._memory_conn = SharedConnection(conn)
+                self._memory_persisted = self._memory_state(conn)
+                self._memory_file = self._memory_file_state()
+                if self.database_filepath is not None:
+                    self._memory_timer_start()
+            return self._memory_conn
+            
+    def _memory_load(self, conn):
+        """Copy database_filepath into the empty :memory: database of conn:
+        tables with their rows, virtual tables with the rows of their
+        shadow tables, then indexes and triggers."""
+        start = time.time()
+        conn.execute("ATTACH DATABASE ? AS disk", (self.database_filepath,))
+        objects = conn.execute("""SELECT type, name, sql FROM disk.sqlite_master
+            WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+            ORDER BY type <> 'table', rowid""").fetchall()
+        virtual = [name for type_, name, sql in objects 
+                   if sql.upper().startswith("CREATE VIRTUAL TABLE")]
+        # keeps the file's setting when written back
+        conn.execute("PRAGMA main.auto_vacuum = %d" % conn.execute(
+                "PRAGMA disk.auto_vacuum").fetchone())
+        # virtual tables first: they create their shadow tables themselves
+        for type_, name, sql in objects:
+            if name in virtual:
+                conn.execute(sql)
+        created = set(row[0] for row in conn.execute(
+                "SELECT name FROM main.sqlite_master"))
+        for type_, name, sql in objects:
+            if type_ == 'table' and name not in virtual:
+                if name not in created:
+                    conn.execute(sql)
+                quoted = '"%s"' % (name.replace('"', '""'),)
+                conn.execute("DELETE FROM main." + quoted)
+                conn.execute("INSERT INTO main.%s SELECT * FROM disk.%s" % 
+                             (quoted, quoted))
+        for type_, name, sql in objects:
+            if type_ != 'table':
+                conn.execute(sql)
+        conn.execute("PRAGMA main.user_version = %d" % conn.execute(
+                "PRAGMA disk.user_version").fetchone())
+        conn.commit()
+        conn.execute("DETACH DATABASE disk")
+        logging.info('DB: Loaded %s into memory in %.2fs' % 
+                     (self.database_filepath, time.time() - start))
+        
+    def _memory_state(self, conn):
+        """Changes so far, to tell whether persist() has something to do."""
+        return (conn.total_changes, 
+                conn.execute("PRAGMA schema_version").fetchone()[0])
+        
+    def _memory_file_state(self):
+        """Modification time and size of database_filepath and its WAL,
+        None for a missing one, to tell whether someone else wrote it."""
+        if self.database_filepath is None:
+            return None
+        state = []
+        for filepath in (self.database_filepath, 
+                         self.database_filepath + "-wal"):
+            try:
+                stat = os.stat(filepath)
+                state.append((stat.st_mtime, stat.st_size))
+            except OSError:
+                state.append(None)
+        return state
+        
+    def persist(self):
+        """Write the in-memory database back to database_filepath if it 
+        changed since it was loaded or last written: as a copy next to it,
+        which then replaces it, so that the file is always complete.
+        Only taking the copy holds the connection, the whole database is 
+        written (there is no backup API to copy changed pages with in 
+        Python 2); syncing and replacing the file does not.
+        If the file changed since it was loaded or last written, another
+        process used it: it is left alone and the copy is kept as 
+        database_filepath + MEMORY_CONFLICT_SUFFIX, with a warning.
+        Returns whether it wrote database_filepath."""
+        if not self.memory or self.database_filepath is None:
+            return False
+        self.flush()
+        # the timer and close() both persist
+        with self._memory_persist_lock:
+            with self.connection() as conn:
+                state = self._memory_state(conn)
+                if state == self._memory_persisted:
+                    return False
+                start = time.time()
+                temporary = self.database_filepath + ".tmp"
+                self.snapshot(temporary)
+            locked = time.time() - start
+            with open(temporary, 'rb+') as snapshot_file:
+                os.fsync(snapshot_file.fileno())
+            target = self.database_filepath
+            if self._memory_file_state() != self._memory_file:
+                target += MEMORY_CONFLICT_SUFFIX
+                logging.warning('DB: %s changed since it was loaded into '
+                                'memory, not overwritten: wrote %s instead' %
+                                (self.database_filepath, target))
+            if os.name == 'nt' and os.path.exists(target):
+                # no atomic replace in Python 2 on Windows
+                os.remove(target)
+            os.rename(temporary, target)
+            self._memory_persisted = state
+            if target == self.database_filepath:
+                self._memory_file = self._memory_file_state()
+        logging.info('DB: Wrote memory to %s in %.2fs (%.2fs locked)' % 
+                     (target, time.time() - start, locked))
+        return target == self.database_filepath
+        
+    def snapshot(self, filepath):
+        """Write a consistent copy of the database as it is now to 
+        filepath, replacing what is there (VACUUM INTO, SQLite 3.27)."""
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        with self.connection() as conn:
+            conn.execute("VACUUM INTO ?", (filepath,))
+        
+    def _memory_timer_start(self):
+        self._memory_timer = threading.Timer(MEMORY_PERSIST_SECONDS,
+                                             self._memory_timer_persist)
+        self._memory_timer.daemon = True
+        self._memory_timer.start()
+        
+    def _memory_timer_persist(self):
+        try:
+            self.persist()
+        except Exception:
+            logging.exception("DB: Writing the memory database failed")
+        with self._connections_lock:
+            # not if close() stopped it meanwhile
+            if self._memory_timer is not None:
+                self._memory_timer_start()
+        
+    def close(self):
+        """Close all connections opened by this model, after a background
+        alive check has finished and buffered moves are written. 
+        With memory the database is written back first.
+        A later call of connection() opens a fresh one.
+        Other threads must be done with the model: their connections are
+        closed as well, one in use would fail under them."""
+        self.alive_check_wait()
+        self.flush()
+        with self._connections_lock:
+            timer, self._memory_timer = self._memory_timer, None
+        if timer is not None:
+            timer.cancel()
+            if timer is not threading.current_thread():
+                timer.join()
+        if self._memory_conn is not None:
+            self.persist()
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+            self._memory_conn = None
+        for thread, conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def _connection_release(self):
+        """Close the connection of the calling thread, if it has one
+        (not the shared one of memory)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            with self._connections_lock:
+                self._connections = [entry for entry in self._connections
+                                     if entry[1] is not conn]
+            conn.close()
+            self._local.conn = None
+
+    def _alive_check_run(self):
+        try:
+            retired = self.folders_postload_exist_check()
+        except Exception:
+            # the caller still learns that the check is over
+            logging.exception("DB: Background alive check failed")
+            retired = []
+        finally:
+            self._connection_release()
+        if self.alive_check_done is not None:
+            self.alive_check_done(retired)
+
+    def alive_check_wait(self, timeout=None):
+        """Block until a background alive check is finished.
+        Returns False if it is still running after timeout seconds."""
+        if self.alive_check_thread is not None:
+            self.alive_check_thread.join(timeout)
+            return not self.alive_check_thread.is_alive()
+        return True
         
- 
+    def __enter__(self):
+        return self
         
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def stats(self):
+        """Snapshot of the instrumentation, see Instrumentation.stats().
+        None if the model was not created with instrument."""
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.stats()
+
+    def stats_reset(self):
+        if self.instrumentation is not None:
+            self.instrumentation.reset()
+
     def folders_postload_exist_check(self):
         """if bookmark: recheck always, unless retired
         if other: recheck 5 times then retire location
         if reactivated by any means, remove retirement flag
+        Returns the folders retired by this check.
         """
 
-        def dict_factory(cursor, row):
-            d = {}
-            for idx, col in enumerate(cursor.description):
-                d[col[0]] = row[idx]
-            return d
-    
-        with sqlite3.connect(**self.connect_args) as conn:
-            conn.row_factory = dict_factory
+        with self.connection() as conn:
+            # on the cursor only, the connection is shared
             cur = conn.cursor()
-            rows = cur.execute("""SELECT folder_path, alive_checks_failed, 
-                        flag_bookmark, flag_retired FROM target_folder""").fetchall()
+            cur.row_factory = dict_factory
+            rows = cur.execute("""SELECT folder_path, alive_checks_failed,
+                        flag_bookmark, flag_retired FROM target_folder
+                        WHERE flag_retired=0""").fetchall()
+
+        # probe all folders at once, away from the database connection
+        exists = folders_exist_probe([row['folder_path'] for row in rows])
+
+        failed = []
+        for row in rows:
+            ff = row['folder_path']
+            if not exists[ff]:
+                ffe = ff.encode('ascii', 'backslashreplace')
+                logging.debug("DB: Folder not found, failing alive check: %s" % (ffe,))
+                failed.append(ff)
+
+        retired = []
+        if failed:
+            retired = self._alive_checks_write(failed)
+        for ff in retired:
+            ffe = ff.encode('ascii', 'backslashreplace')
+            logging.info("DB: Folder temporarily retired: %s" % (ffe,))
+        return retired
+        
+    @retry_on_locked
+    def _alive_checks_write(self, failed):
+        """Count a failed alive check for the folders in failed, retiring
+        the fifth time unless bookmarked. Against the rows as they are 
+        now, not as read before the probe: they may have been bookmarked 
+        or checked by another process meanwhile. Returns those retired."""
+        checked = []
+        with self.connection() as conn:
+            for ff in failed:
+                # SET reads the row as it was before the update
+                if conn.execute("""UPDATE target_folder
+                    SET alive_checks_failed = alive_checks_failed + 1,
+                        flag_retired = (alive_checks_failed + 1 > 4 AND
+                                        flag_bookmark IS NOT 1)
+                    WHERE folder_path = ? AND flag_retired = 0""", 
+                    (ff,)).rowcount:
+                    checked.append((ff,) + tuple(conn.execute("""SELECT 
+                        alive_checks_failed, flag_retired FROM target_folder
+                        WHERE folder_path = ?""", (ff,)).fetchone()))
+        retired = []
+        for ff, alive_checks_failed, flag_retired in checked:
+            self._folders_cache_update(ff, 
+                                       alive_checks_failed=alive_checks_failed,
+                                       flag_retired=flag_retired)
+            if flag_retired:
+                retired.append(ff)
+        return retired
 
-        with sqlite3.connect(**self.connect_args) as conn:
-            
-            for row in rows:
-                ff = row['folder_path']
-                if row['flag_retired'] == False and \
-                            not QtCore.QDir(ff).exists():
-                    ffe = ff.encode('ascii', 'backslashreplace')
-                    logging.debug("DB: Folder not found, failing alive check: %s" % (ffe,))
-                
-                    update_alive = row['alive_checks_failed'] + 1
-                    conn.execute("""UPDATE OR IGNORE target_folder 
-                        SET alive_checks_failed = ?
-                        WHERE folder_path = ?""", (update_alive, ff))
-                    
-                    if update_alive > 4 and row['flag_bookmark'] != True:
-                        conn.execute("""UPDATE OR IGNORE target_folder 
-                            SET flag_retired = ?
-                            WHERE folder_path = ?""", (True, ff))
-                        logging.info("DB: Folder temporarily retired: %s" % (ffe,))
-    
                         
     def bookmark_add(self, folderpath):
-        ff = folder_path_normalize(folderpath)
+        return self.bookmark_add_many([folderpath])[0]
         
+    @retry_on_locked
+    def bookmark_add_many(self, folderpaths):
+        """Bookmark several folders in one transaction.
+        Returns one result per path, in order, like bookmark_add():
+        "added" or "already_in_data".
+        """
+        ffs = [folder_path_normalize(folderpath) for folderpath in folderpaths]
         
         # also possible: INSERT OR IGNORE
         
-        with sqlite3.connect(**self.connect_args) as conn:
-            cur = conn.cursor()
-            row = cur.execute("SELECT * FROM target_folder WHERE folder_path=?", 
-                    (ff, )).fetchone()
-            if row:
-                conn.execute("""UPDATE target_folder 
-                    SET flag_bookmark = ?
-                    WHERE folder_path = ?""", (True, ff))
-                result = "already_in_data"
-            else:
-                conn.execute("""INSERT INTO target_folder 
-                    (folder_path, alive_checks_failed, flag_bookmark, 
-                     flag_explorer_open, flag_private, flag_retired)
-                    VALUES(?, ?, ?, ?, ?, ?)""", 
-                    (ff, 0, True, False, False, False))
-                result = "added"
-        return result
+        with self.connection() as conn:
+            known = set()
+            ffs_unique = list(set(ffs))
+            # stay below SQLITE_MAX_VARIABLE_NUMBER (999)
+            for start in range(0, len(ffs_unique), 500):
+                chunk = ffs_unique[start:start + 500]
+                known.update(row[0] for row in conn.execute(
+                        """SELECT folder_path FROM target_folder 
+                        WHERE folder_path IN (%s)""" % 
+                        ",".join("?" * len(chunk)), chunk))
+            
+            results = []
+            inserts = []
+            for ff in ffs:
+                if ff in known:
+                    results.append("already_in_data")
+                else:
+                    known.add(ff)
+                    inserts.append((ff, 0, True, False, False, False))
+                    results.append("added")
+            
+            conn.executemany("""UPDATE target_folder 
+                SET flag_bookmark = ?
+                WHERE folder_path = ?""", 
+                [(True, ff) for ff in ffs_unique])
+            conn.executemany("""INSERT INTO target_folder 
+                (folder_path, alive_checks_failed, flag_bookmark, 
+                 flag_explorer_open, flag_private, flag_retired)
+                VALUES(?, ?, ?, ?, ?, ?)""", inserts)
+        for ff in ffs_unique:
+            self._folders_cache_update(ff, flag_bookmark=True)
+        return results
 
         
+    @retry_on_locked
     def bookmark_remove(self, folderpath):
         ff = folder_path_normalize(folderpath)
+        # a folder only moved to so far has its row in the buffer
+        self.flush()
         
-        with sqlite3.connect(**self.connect_args) as conn:
+        with self.connection() as conn:
             conn.execute("""UPDATE OR IGNORE target_folder 
                 SET flag_bookmark = ?
                 WHERE folder_path = ?""", (False, ff))
+        self._folders_cache_update(ff, flag_bookmark=False)
         
         
+    @retry_on_locked
     def folder_remove(self, folderpath):
         ff = folder_path_normalize(folderpath)
         ffe = ff.encode('ascii', 'backslashreplace')
+        # buffered moves must not bring the folder back afterwards
+        self.flush()
         
         # It's possible to do this also with foreign keys and ON DELETE CASCADE
         # but then I would have to call a pragma before each connection.
         # https://www.sqlite.org/foreignkeys.html
         
-        with sqlite3.connect(**self.connect_args) as conn:
+        with self.connection() as conn:
             cur = conn.cursor()
             row = cur.execute("SELECT * FROM target_folder WHERE folder_path=?", 
                     (ff, )).fetchone()
@@ -184,30 +1410,126 @@ class Model:
                     WHERE folder_path = ?""", (ff,))
                 logging.debug('SQL: Removed from target_folder: %s' % (ffe,))
                 
+            # first, so that the move_latest triggers find nothing to recount
+            conn.execute("""DELETE FROM folder_stats 
+                WHERE target_folder = ?""", (ff,))
             row = cur.execute("SELECT * FROM move_latest WHERE target_folder=?", 
                     (ff, )).fetchone()
             if row:
                 conn.execute("""DELETE FROM move_latest 
                     WHERE target_folder = ?""", (ff,))
                 logging.debug('SQL: Removed from move_latest: %s' % (ffe,))
+        self.cache_invalidate(ff)
             
         
+    @retry_on_locked
     def folder_flag_set(self, folderpath, flag_name, flag_bool):
         ff = folder_path_normalize(folderpath)
+        # a folder only moved to so far has its row in the buffer
+        self.flush()
         
-        with sqlite3.connect(**self.connect_args) as conn:
+        with self.connection() as conn:
             conn.execute("""UPDATE OR IGNORE target_folder 
                 SET """ + flag_name + """=?
                 WHERE folder_path = ?""", (flag_bool, ff))
+        self._folders_cache_update(ff, **{flag_name: flag_bool})
     
     def folder_flag_get(self, folderpath, flag_name):
         ff = folder_path_normalize(folderpath)
         
-        with sqlite3.connect(**self.connect_args) as conn:
-            row = conn.execute("""SELECT """ + flag_name + 
-                    """ FROM target_folder WHERE folder_path=?""", 
-                               (ff, )).fetchone()
-            return bool(row[0])
+        row = self._folder_cached(ff)
+        return bool(row[flag_name])
+        
+    def _folder_cached(self, ff):
+        """The target_folder row of ff as dict, from the cache.
+        The cache is filled with all rows on first use; a folder missing
+        in it (added meanwhile by moves, or by another process) is read
+        on its own. None if ff is not in the database at all.
+        """
+        with self._folders_lock:
+            if self._folders_cache is None:
+                with self.connection() as conn:
+                    cur = conn.cursor()
+                    cur.row_factory = dict_factory
+                    self._folders_cache = dict(
+                        (row['folder_path'], row) for row in 
+                        cur.execute("SELECT * FROM target_folder"))
+            row = self._folders_cache.get(ff)
+        if row is not None:
+            return row
+            
+        # its row may still be in the write-behind buffer
+        self.flush()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.row_factory = dict_factory
+            row = cur.execute("SELECT * FROM target_folder WHERE folder_path=?",
+                              (ff, )).fetchone()
+        if row is not None:
+            with self._folders_lock:
+                if self._folders_cache is not None:
+                    self._folders_cache[ff] = row
+        return row
+        
+    def _folders_cache_update(self, ff, **values):
+        """Apply a successful write to the cached row of ff, if cached."""
+        with self._folders_lock:
+            if self._folders_cache is not None and ff in self._folders_cache:
+                self._folders_cache[ff].update(values)
+                
+    def cache_invalidate(self, folderpath=None):
+        """Forget the cached flags of folderpath, or of all folders, and
+        the cached moves. Call this when another process has written to
+        the database."""
+        with self._folders_lock:
+            if folderpath is None:
+                self._folders_cache = None
+            elif self._folders_cache is not None:
+                self._folders_cache.pop(folder_path_normalize(folderpath), 
+                                        None)
+        self._suggest_cache_drop()
+        
+    def _suggest_moves(self, file_extension_db):
+        """The moves of an extension, from the cache, as View.suggest()
+        weighs them: [(folder, filename length, times moved, times halved
+        every SUGGEST_HALF_LIFE_DAYS until they were read, latest move 
+        date as text)]. The halving since the read is the same for all of
+        them, so it does not change their order."""
+        with self._suggest_lock:
+            moves = self._suggest_cache.get(file_extension_db)
+            generation = self._suggest_generation
+        if moves is not None:
+            return moves
+        
+        with self.connection() as conn:
+            # age and date string in SQL: no timestamp conversion per row
+            rows = conn.execute("""SELECT target_folder, filename_length,
+                    moved_times, """ + 
+                    self.date_sql("moved_latest_date") + """, 
+                    """ + self.age_days_sql("moved_latest_date") + """
+                FROM move_latest WHERE file_extension=?""",
+                (file_extension_db,)).fetchall()
+        moves = []
+        for ff, length, moved_times, moved_latest_date, age_days in rows:
+            moved_times = moved_times or 0
+            decayed = float(moved_times)
+            if age_days is not None:
+                decayed *= 0.5 ** (max(age_days, 0) / SUGGEST_HALF_LIFE_DAYS)
+            moves.append((ff, length, moved_times, decayed, moved_latest_date))
+        with self._suggest_lock:
+            if self._suggest_generation == generation:
+                self._suggest_cache[file_extension_db] = moves
+        return moves
+        
+    def _suggest_cache_drop(self, file_extensions=None):
+        """Forget the cached moves of file_extensions, or of all."""
+        with self._suggest_lock:
+            self._suggest_generation += 1
+            if file_extensions is None:
+                self._suggest_cache = {}
+            else:
+                for file_extension in file_extensions:
+                    self._suggest_cache.pop(file_extension, None)
         
         
     def file_explorer_toggle(self, folderpath):
@@ -230,167 +1552,691 @@ class Model:
            
                 
     def statistics_update_post_move(self, folderpath, filename):
+        self.statistics_update_post_move_many(folderpath, [filename])
+        
+    def statistics_update_post_move_many(self, folderpath, filenames):
+        """Record that all filenames were moved to folderpath, 
+        in one transaction (or into the write-behind buffer at once)."""
         ff = folder_path_normalize(folderpath)
+        now = datetime.datetime.now()
         
-        # add fresh folder in case we use alternative move to methods
-        with sqlite3.connect(**self.connect_args) as conn:
-            conn.execute("""INSERT OR IGNORE INTO target_folder 
-                    (folder_path, alive_checks_failed, flag_bookmark, 
-                     flag_explorer_open, flag_private, flag_retired)
-                    VALUES(?, ?, ?, ?, ?, ?)""", 
-                    (ff, 0, False, False, False, False))
-    
+        # merge per extension and length first
+        moves = {}
+        for filename in filenames:
+            move = (ff,) + self._filename_key(filename)
+            moves[move] = moves.get(move, 0) + 1
+        if not moves:
+            return
+        
+        if not self.write_behind:
+            self._moves_write([move + (moved_times, now) 
+                               for move, moved_times in moves.items()])
+            return
+            
+        with self._moves_lock:
+            for move, moved_times in moves.items():
+                pending_times, _ = self._moves_pending.get(move, (0, None))
+                self._moves_pending[move] = (pending_times + moved_times, now)
+                self._moves_pending_count += moved_times
+            if self._moves_pending_count >= WRITE_BEHIND_MAX_MOVES:
+                self.flush()
+            elif self._moves_timer is None:
+                self._moves_timer = threading.Timer(WRITE_BEHIND_MAX_SECONDS,
+                                                    self._moves_timer_flush)
+                self._moves_timer.daemon = True
+                self._moves_timer.start()
+                
+    def _filename_key(self, filename):
+        """(extension, filename length) of a moved file, normalized the 
+        way move_latest stores them."""
         file_basename, file_extension = os.path.splitext(filename)
         filename_length = len(file_basename)
         if file_extension == "":
             file_extension_db = "(none)"
         else:
             file_extension_db = file_extension.lower()
-        now = datetime.datetime.now()
+        return (file_extension_db, filename_length)
         
-        with sqlite3.connect(**self.connect_args) as conn:
-            conn.execute("""INSERT OR IGNORE INTO move_latest 
-                (file_extension, filename_length, target_folder, 
-                 moved_latest_date, moved_times)
-                VALUES(?, ?, ?, ?, ?)""", 
-                (file_extension_db, filename_length, ff, now, 0))
-            conn.execute("""UPDATE move_latest 
-                SET moved_latest_date=? , moved_times=moved_times+1
-                WHERE target_folder=? and file_extension=? and filename_length=?""", 
-                (now, ff, file_extension_db, filename_length))
+    @retry_on_locked
+    def _moves_write(self, moves):
+        """Record moves, given as tuples (folder, extension, filename length,
+        times moved, latest move date), in one transaction."""
+        with self.connection() as conn:
+            self._moves_write_conn(conn, moves)
+        self._suggest_cache_drop(set(move[1] for move in moves))
+            
+    def _moves_write_conn(self, conn, moves):
+        # add fresh folders in case we use alternative move to methods
+        conn.executemany("""INSERT OR IGNORE INTO target_folder 
+                (folder_path, alive_checks_failed, flag_bookmark, 
+                 flag_explorer_open, flag_private, flag_retired)
+                VALUES(?, ?, ?, ?, ?, ?)""", 
+                [(ff, 0, False, False, False, False) 
+                 for ff in set(move[0] for move in moves)])
+        # in the transaction now, which holds the write lock: no other
+        # process can migrate between this and the dates written
+        self._timestamps_epoch_refresh(conn)
+        conn.executemany("""INSERT OR IGNORE INTO move_latest 
+            (file_extension, filename_length, target_folder, 
+             moved_latest_date, moved_times)
+            VALUES(?, ?, ?, ?, ?)""", 
+            [(ext, length, ff, self.date_db(latest), 0) 
+             for ff, ext, length, _, latest in moves])
+        conn.executemany("""UPDATE move_latest 
+            SET moved_latest_date=? , moved_times=moved_times+?
+            WHERE target_folder=? and file_extension=? and filename_length=?""", 
+            [(self.date_db(latest), moved_times, ff, ext, length) 
+             for ff, ext, length, moved_times, latest in moves])
              
+    def flush(self):
+        """Write the moves buffered by write_behind in one transaction.
+        Called by the View before reading, and by close()."""
+        with self._moves_lock:
+            if self._moves_timer is not None:
+                self._moves_timer.cancel()
+                self._moves_timer = None
+            if not self._moves_pending:
+                return
+            moves = [move + pending 
+                     for move, pending in self._moves_pending.items()]
+            self._moves_write(moves)
+            logging.debug("DB: Flushed %d moves" % (self._moves_pending_count,))
+            self._moves_pending = {}
+            self._moves_pending_count = 0
+            
+    def _moves_timer_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("DB: Flushing buffered moves failed")
+        finally:
+            self._connection_release()
+            
+    def maintenance(self, budget=MAINTENANCE_BUDGET_SECONDS,
+                    retired_days=MAINTENANCE_RETIRED_DAYS,
+                    stale_days=MAINTENANCE_STALE_DAYS,
+                    stale_times=MAINTENANCE_STALE_TIMES,
+                    max_moves=MAINTENANCE_MAX_MOVES):
+        """One slice of housekeeping, about budget seconds, for idle time:
+        purge the history of folders retired longer than retired_days,
+        drop moves older than stale_days made at most stale_times times,
+        drop the oldest moves beyond max_moves, then give free pages back
+        to the file system (only with auto_vacuum=INCREMENTAL, see 
+        auto_vacuum_incremental_enable()). A rule set to None is skipped.
+        Every chunk is a short transaction of its own, so the GUI thread
+        and other processes get the database in between; the moves to 
+        drop are found by the MAINTENANCE_SCHEMA indexes, a chunk reads 
+        no more rows than it deletes.
+        Returns True while there is more to do: call again, e.g. from an
+        idle QTimer, until it returns False. The next call goes on where
+        this one stopped, so every step gets its turn.
+        """
+        deadline = time.time() + budget
+        steps = []
+        if retired_days is not None:
+            # from folder_retired, not by a scan of move_latest
+            steps.append(lambda: self._moves_purge("""SELECT rowid 
+                FROM move_latest WHERE target_folder IN (
+                    SELECT folder_path FROM folder_retired 
+                    WHERE retired_date < julianday('now') - ?)""", 
+                (retired_days,)))
+        if stale_days is not None and stale_times is not None:
+            with self.connection() as conn:
+                self._timestamps_epoch_refresh(conn)
+            stale_before = self.date_db(datetime.datetime.now() - 
+                                        datetime.timedelta(days=stale_days))
+            # IN, not <=: a range of dates in each moved_times of the 
+            # index; without statistics SQLite may take the date index, 
+            # which reads all old moves, however often made
+            times = range(stale_times + 1)
+            steps.append(lambda: self._moves_purge("""SELECT rowid 
+                FROM move_latest INDEXED BY move_latest_times_date
+                WHERE moved_times IN (%s) 
+                AND moved_latest_date < ?""" % (",".join("?" * len(times)),),
+                tuple(times) + (stale_before,)))
+        if max_moves is not None:
+            steps.append(lambda: self._moves_purge_oldest(max_moves))
+        steps.append(self._vacuum_step)
+        
+        while self._maintenance_step < len(steps):
+            if time.time() >= deadline:
+                return True
+            if steps[self._maintenance_step]():
+                self._maintenance_step += 1
+        self._maintenance_step = 0
+        return False
+        
+    @retry_on_locked
+    def _moves_purge(self, query, parameters, limit=MAINTENANCE_CHUNK_ROWS):
+        """Delete up to limit move_latest rows whose rowids query selects.
+        Returns True if that was the last of them."""
+        with self.connection() as conn:
+            rowids = [row[0] for row in conn.execute(query + " LIMIT ?", 
+                                                     parameters + (limit,))]
+            if rowids:
+                self._moves_delete(conn, rowids)
+        if rowids:
+            self._suggest_cache_drop()
+        logging.debug("DB: Purged %d moves" % (len(rowids),))
+        return len(rowids) < limit
+        
+    def _moves_purge_oldest(self, max_moves):
+        with self.connection() as conn:
+            excess = conn.execute("SELECT count(*) FROM move_latest"
+                                  ).fetchone()[0] - max_moves
+        if excess <= 0:
+            return True
+        self._moves_purge("SELECT rowid FROM move_latest "
+                          "ORDER BY moved_latest_date", (), 
+                          min(excess, MAINTENANCE_CHUNK_ROWS))
+        return False
+        
+    def _moves_delete(self, conn, rowids):
+        """Delete move_latest rows, updating the folder_stats of their 
+        folders once instead of the triggers doing so per row: the deleted
+        moves are taken off, a latest date is only looked up anew if it
+        was deleted, per extension in move_latest, per folder in the 
+        extensions of the folder."""
+        marks = ",".join("?" * len(rowids))
+        # (folder, extension or '') -> (times, latest date) deleted
+        deleted = {}
+        for folder, extension, times, latest in conn.execute("""SELECT 
+            target_folder, file_extension, SUM(moved_times), 
+            MAX(moved_latest_date) FROM move_latest WHERE rowid IN (%s)
+            GROUP BY target_folder, file_extension""" % (marks,), rowids):
+            for key in ((folder, extension), (folder, '')):
+                deleted_times, deleted_latest = deleted.get(key, (0, None))
+                deleted[key] = (deleted_times + times, 
+                                max(deleted_latest, latest))
+        stats = {}
+        for key in deleted:
+            stats[key] = conn.execute("""SELECT moved_times, moved_latest_date
+                FROM folder_stats WHERE target_folder = ? 
+                AND file_extension = ?""", key).fetchone()
+        # without their stats rows the delete trigger finds nothing to do
+        conn.executemany("""DELETE FROM folder_stats WHERE target_folder = ?
+            AND file_extension = ?""", list(deleted))
+        conn.execute("DELETE FROM move_latest WHERE rowid IN (%s)" % (marks,),
+                     rowids)
+        recount = []
+        for key, (times, latest) in deleted.items():
+            row = stats[key]
+            if row is not None and latest < row[1]:
+                # the latest move is left, and so is the row
+                conn.execute("INSERT INTO folder_stats VALUES(?, ?, ?, ?)", 
+                             key + (row[0] - times, row[1]))
+            else:
+                recount.append(key)
+        # extensions first, the folder totals are counted from them
+        recount.sort(key=lambda key: key[1] == '')
+        for folder, extension in recount:
+            if extension:
+                # by the extension index: an extension has a row per 
+                # filename length at most, a folder may have any number
+                # (unary + keeps SQLite from using the target_folder index)
+                conn.execute("""INSERT INTO folder_stats
+                    SELECT target_folder, file_extension, SUM(moved_times),
+                        MAX(moved_latest_date)
+                    FROM move_latest 
+                    WHERE +target_folder = ? AND file_extension = ?
+                    GROUP BY target_folder, file_extension""", 
+                    (folder, extension))
+            else:
+                conn.execute("""INSERT INTO folder_stats
+                    SELECT target_folder, '', SUM(moved_times), 
+                        MAX(moved_latest_date)
+                    FROM folder_stats 
+                    WHERE target_folder = ? AND file_extension <> ''
+                    GROUP BY target_folder""", (folder,))
+            
+    def _vacuum_step(self):
+        """Give up to MAINTENANCE_VACUUM_PAGES free pages back.
+        Returns True if none are left (or auto_vacuum is not incremental)."""
+        with self.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return True
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free:
+                conn.execute("PRAGMA incremental_vacuum(%d)" % 
+                             (MAINTENANCE_VACUUM_PAGES,)).fetchall()
+        return free <= MAINTENANCE_VACUUM_PAGES
+        
+    def auto_vacuum_incremental_enable(self):
+        """Switch a database created before auto_vacuum=INCREMENTAL was 
+        the default to it, so that maintenance() can shrink the file. 
+        Rewrites the whole file (VACUUM) and blocks meanwhile: run it once,
+        from a tool or at shutdown, not from the GUI."""
+        self.flush()
+        # "with" for the lock of a shared connection: neither statement
+        # begins a transaction
+        with self.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return
+            logging.info('DB: Switching to auto_vacuum=INCREMENTAL')
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            
             
 class View():
     def __init__(self, model):
         self.model = model
+        if model.instrumentation is not None:
+            for name in VIEW_TIMED_METHODS:
+                setattr(self, name, model.instrumentation.method_timed(
+                        "View." + name, getattr(self, name)))
             
     def str_from_boolean(self, bool):
         return 'yes' if bool else 'no'
-
-    def bookmarks_generate(self, private_include=False):
-        with sqlite3.connect(**self.model.connect_args) as conn:
-            # Find all bookmarked folders
-            rows = conn.execute("""SELECT folder_path, flag_explorer_open 
-                    FROM target_folder WHERE flag_bookmark=? AND 
-                    flag_retired=? AND flag_private IN (?,?)""",(True, False, 
-                                        False, private_include)).fetchall()
-
+        
+    def _folders_generate(self, query, parameters, limit=None, offset=0,
+                          order_by='path', after=None):
+        """Run one query and yield its rows in the view format.
+        The query must select folder_path, flag_explorer_open, 
+        the summed moved_times and the latest move date already cut to 
+        seconds ('' if there is none), in this order, and end in WHERE.
+        Paging: order_by is a key of VIEW_ORDER_BY (None: as stored),
+        limit/offset cut the result; with order_by 'path', after=folder_path
+        continues behind that folder without counting off the rows before.
+        No statement stays open while the caller holds a row: an open
+        read keeps a SHARED lock on the file (rollback journal), which 
+        fails the writes of all other threads and processes. So by path
+        without limit the rows come VIEW_FETCH_BATCH at a time, each batch
+        a query of its own that goes on behind the last folder; otherwise
+        the result is read at once (other orders sort all of it anyway).
+        """
+        parameters = list(parameters)
+        if after is not None and order_by != 'path':
+            raise ValueError("after needs order_by='path'")
+        self.model.flush()
+        
+        if order_by != 'path' or limit is not None:
+            if after is not None:
+                query += " AND t.folder_path > ?"
+                parameters.append(after)
+            if order_by is not None:
+                query += " ORDER BY " + VIEW_ORDER_BY[order_by]
+            if limit is not None or offset:
+                query += " LIMIT ? OFFSET ?"
+                parameters += [-1 if limit is None else limit, offset]
+            with self.model.connection() as conn:
+                rows = conn.execute(query, parameters).fetchall()
             for row in rows:
-                # For each bookmarked folder, get additional data
-                moved_times = conn.execute("""SELECT SUM(moved_times) 
-                    FROM move_latest WHERE target_folder=?""",(row[0],)).fetchone()[0]
-                if not moved_times:
-                    moved_times = 0
-                timestamp_str = conn.execute("""SELECT MAX(moved_latest_date) 
-                    FROM move_latest WHERE target_folder=?""",(row[0],)).fetchone()[0]
-                if timestamp_str:
-                    timestamp = datetime.datetime.strptime(
-                            timestamp_str, "%Y-%m-%d %H:%M:%S.%f")
-                    moved_latest_date_str = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                else:
-                    moved_latest_date_str = ''
-                
-                yield(str(moved_times), row[0], moved_latest_date_str, 
+                yield(str(row[2]), row[0], row[3], 
                       self.str_from_boolean(row[1]))
-
-                
-    def all_generate(self, private_include=False):
-        with sqlite3.connect(**self.model.connect_args) as conn:
-            # Find all folders
-            rows = conn.execute("""SELECT folder_path, flag_explorer_open 
-                    FROM target_folder WHERE  
-                    flag_retired=? AND flag_private IN (?,?)""",(False, 
-                                        False, private_include)).fetchall()
+            return
+            
+        while True:
+            batch_query = query
+            batch_parameters = list(parameters)
+            if after is not None:
+                batch_query += " AND t.folder_path > ?"
+                batch_parameters.append(after)
+            batch_query += (" ORDER BY " + VIEW_ORDER_BY['path'] + 
+                            " LIMIT ? OFFSET ?")
+            batch_parameters += [VIEW_FETCH_BATCH, offset]
+            with self.model.connection() as conn:
+                rows = conn.execute(batch_query, batch_parameters).fetchall()
             for row in rows:
-                # For each folder, get additional data
-                moved_times = conn.execute("""SELECT SUM(moved_times) 
-                    FROM move_latest WHERE target_folder=?""",(row[0],)).fetchone()[0]
-                if not moved_times:
-                    moved_times = 0
-                timestamp_str = conn.execute("""SELECT MAX(moved_latest_date) 
-                    FROM move_latest WHERE target_folder=?""",(row[0],)).fetchone()[0]
-                if timestamp_str:
-                    timestamp = datetime.datetime.strptime(
-                            timestamp_str, "%Y-%m-%d %H:%M:%S.%f")
-                    moved_latest_date_str = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                else:
-                    moved_latest_date_str = ''
-                
-                yield(str(moved_times), row[0], moved_latest_date_str, 
+                yield(str(row[2]), row[0], row[3], 
                       self.str_from_boolean(row[1]))
+            if len(rows) < VIEW_FETCH_BATCH:
+                return
+            after = rows[-1][0]
+            offset = 0
+
+    def bookmarks_generate(self, private_include=False, **paging):
+        # All bookmarked folders, with their totals from folder_stats.
+        # LEFT JOIN: bookmarks nothing was moved to yet are listed, too.
+        return self._folders_generate("""SELECT t.folder_path, 
+                    t.flag_explorer_open, 
+                    COALESCE(s.moved_times, 0), 
+                    COALESCE(""" + 
+                        self.model.date_sql("s.moved_latest_date") + 
+                        """, '')
+                FROM target_folder AS t 
+                LEFT JOIN folder_stats AS s 
+                    ON s.target_folder = t.folder_path AND s.file_extension=''
+                WHERE t.flag_bookmark=1 AND t.flag_retired=0 AND 
+                    t.flag_private IN (0,?)""", 
+                (private_include,), **paging)
+
+    def all_generate(self, private_include=False, **paging):
+        # All folders, with their totals from folder_stats
+        return self._folders_generate("""SELECT t.folder_path, 
+                    t.flag_explorer_open, 
+                    COALESCE(s.moved_times, 0), 
+                    COALESCE(""" + 
+                        self.model.date_sql("s.moved_latest_date") + 
+                        """, '')
+                FROM target_folder AS t 
+                LEFT JOIN folder_stats AS s 
+                    ON s.target_folder = t.folder_path AND s.file_extension=''
+                WHERE t.flag_retired=0 AND t.flag_private IN (0,?)""", 
+                (private_include,), **paging)
                       
-                      
-    def by_extension_generate(self, file_extension, private_include=False):
+    def by_extension_generate(self, file_extension, private_include=False,
+                              **paging):
         file_extension_db = file_extension
         if DATABASE_FILE_EXTENSION_IS_LOWERCASE:
             file_extension_db = file_extension.lower()
-        with sqlite3.connect(**self.model.connect_args) as conn:
-            # Find all valid folders that file_extensions were moved to
-            rows = conn.execute("""SELECT folder_path, flag_explorer_open 
-                    FROM target_folder WHERE  
-                    flag_retired=? AND flag_private IN (?,?) AND
-                    folder_path IN (SELECT DISTINCT target_folder 
-                                    FROM move_latest WHERE  
-                                    file_extension=?)""",
-                    (False, False, private_include, file_extension_db)).fetchall()
-            for row in rows:
-                # For each folder, get additional data
-                moved_times = conn.execute("""SELECT SUM(moved_times) 
-                    FROM move_latest WHERE target_folder=? AND 
-                    file_extension=?""",(row[0],file_extension_db)).fetchone()[0]
-                if not moved_times:
-                    moved_times = 0
-                timestamp_str = conn.execute("""SELECT MAX(moved_latest_date) 
-                    FROM move_latest WHERE target_folder=? AND
-                    file_extension=?""",(row[0],file_extension_db)).fetchone()[0]
-                if timestamp_str:
-                    timestamp = datetime.datetime.strptime(
-                            timestamp_str, "%Y-%m-%d %H:%M:%S.%f")
-                    moved_latest_date_str = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                else:
-                    moved_latest_date_str = ''
-                
-                yield(str(moved_times), row[0], moved_latest_date_str, 
-                      self.str_from_boolean(row[1]))
-    
+        # All valid folders that file_extensions were moved to.
+        # CROSS JOIN keeps the few stats rows of the extension outside,
+        # the planner would otherwise walk all folders.
+        return self._folders_generate("""SELECT t.folder_path, 
+                    t.flag_explorer_open, 
+                    s.moved_times, 
+                    COALESCE(""" + 
+                        self.model.date_sql("s.moved_latest_date") + 
+                        """, '')
+                FROM folder_stats AS s 
+                CROSS JOIN target_folder AS t 
+                    ON t.folder_path = s.target_folder
+                WHERE s.file_extension=? AND s.file_extension<>'' AND 
+                    t.flag_retired=0 AND t.flag_private IN (0,?)""", 
+                (file_extension_db, private_include), **paging)
        
-    def by_extension_and_length_generate(self, file_extension, fn_len, private_include=False):
+    def by_extension_and_length_generate(self, file_extension, fn_len, private_include=False,
+                                         **paging):
         file_extension_db = file_extension
         if DATABASE_FILE_EXTENSION_IS_LOWERCASE:
             file_extension_db = file_extension.lower()
+        # All valid folders that file_extensions of this length were moved to:
+        # at most one, move_latest is keyed on extension and length
+        return self._folders_generate("""SELECT t.folder_path, 
+                    t.flag_explorer_open, 
+                    m.moved_times, 
+                    COALESCE(""" + 
+                        self.model.date_sql("m.moved_latest_date") + 
+                        """, '')
+                FROM move_latest AS m 
+                CROSS JOIN target_folder AS t 
+                    ON t.folder_path = m.target_folder
+                WHERE m.file_extension=? AND m.filename_length=? AND 
+                    t.flag_retired=0 AND t.flag_private IN (0,?)""", 
+                (file_extension_db, fn_len, private_include), **paging)
+
+    def suggest(self, filename, limit=10, private_include=False):
+        """Target folders for filename, best first, at most limit of them,
+        in the row format of the generators.
+        Every move of the same extension counts, weighted by how well the
+        filename length matches (SUGGEST_WEIGHT_*) and halved every
+        SUGGEST_HALF_LIFE_DAYS since it last happened.
+        """
+        file_extension_db, fn_len = self.model._filename_key(filename)
+        self.model.flush()
+        
+        folders = {}
+        for (ff, length, moved_times, decayed, moved_latest_date) in \
+                self.model._suggest_moves(file_extension_db):
+            row = self.model._folder_cached(ff)
+            if (row is None or row['flag_retired'] or 
+                (row['flag_private'] and not private_include)):
+                continue
+            distance = abs(length - fn_len)
+            if distance == 0:
+                weight = SUGGEST_WEIGHT_EXACT
+            elif distance <= SUGGEST_LENGTH_NEAR:
+                weight = SUGGEST_WEIGHT_LENGTH_NEAR
+            else:
+                weight = SUGGEST_WEIGHT_EXTENSION
+
+            score, times, latest, _ = folders.get(ff, (0.0, 0, '', None))
+            if moved_latest_date is not None and moved_latest_date > latest:
+                latest = moved_latest_date
+            folders[ff] = (score + weight * decayed, times + moved_times, 
+                           latest, row['flag_explorer_open'])
+
+        best = heapq.nlargest(limit, folders.items(),
+                              key=lambda item: item[1][0])
+        return [(str(times), ff, latest, self.str_from_boolean(explorer_open))
+                for ff, (_, times, latest, explorer_open) in best]
+
+    def search(self, query, private_include=False, limit=100):
+        """Folders whose path contains query, ignoring case, best first, 
+        at most limit of them, in the row format of the generators.
+        Folders where query starts a path segment come first, then the 
+        most used ones. Uses the trigram index for queries of 3 characters
+        or more if the model has it (search_indexed), else scans the paths.
+        An empty query lists the most used folders.
+        """
+        if not query:
+            return list(self.all_generate(private_include, limit=limit,
+                                          order_by='moved_times'))
+        # LIKE patterns take query literally, with \ as escape character
+        like = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        segment_start = "%" + os.sep.replace("\\", "\\\\") + like + "%"
+        if self.model.search_indexed and len(query) >= 3:
+            # a quoted phrase matches as a substring with trigrams; the
+            # paths read through folder_search are slower than the join
+            source = """folder_search AS f 
+                CROSS JOIN folder_search_path AS p ON p.id = f.rowid
+                CROSS JOIN target_folder AS t ON t.folder_path = p.folder_path"""
+            condition = "folder_search MATCH ?"
+            match = '"' + query.replace('"', '""') + '"'
+        else:
+            source = "target_folder AS t"
+            condition = "t.folder_path LIKE ? ESCAPE '\\'"
+            match = "%" + like + "%"
+        
+        self.model.flush()
+        with self.model.connection() as conn:
+            rows = conn.execute("""SELECT t.folder_path, 
+                    t.flag_explorer_open, 
+                    COALESCE(s.moved_times, 0), 
+                    COALESCE(""" + 
+                        self.model.date_sql("s.moved_latest_date") + 
+                        """, '')
+                FROM """ + source + """ 
+                LEFT JOIN folder_stats AS s 
+                    ON s.target_folder = t.folder_path AND s.file_extension=''
+                WHERE """ + condition + """ AND 
+                    t.flag_retired=0 AND t.flag_private IN (0,?)
+                ORDER BY ? || t.folder_path NOT LIKE ? ESCAPE '\\', 3 DESC, 1
+                LIMIT ?""", 
+                (match, private_include, os.sep, segment_start, limit)
+                ).fetchall()
+        return [(str(row[2]), row[0], row[3], self.str_from_boolean(row[1]))
+                for row in rows]
+
+
+# AsyncModel/AsyncView: methods run on the writer thread, one after the 
+# other in the order called, and methods run on the reader threads
+ASYNC_READERS = 4
+ASYNC_WRITE_METHODS = ['folders_postload_exist_check', 'bookmark_add',
+                       'bookmark_add_many', 'bookmark_remove', 'folder_remove',
+                       'folder_flag_set', 'file_explorer_toggle',
+                       'file_explorer_set', 'private_set',
+                       'statistics_update_post_move',
+                       'statistics_update_post_move_many', 'flush',
+                       'maintenance', 'folder_stats_rebuild']
+ASYNC_READ_METHODS = ['folder_flag_get', 'file_explorer_get', 'private_get']
+ASYNC_VIEW_METHODS = ['bookmarks_generate', 'all_generate',
+                      'by_extension_generate',
+                      'by_extension_and_length_generate', 'suggest', 'search']
+
+class DatabaseFuture(object):
+    """Result of a call submitted to AsyncModel or AsyncView, 
+    like concurrent.futures.Future, which Python 2 lacks."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        
+    def done(self):
+        return self._done.is_set()
+        
+    def result(self, timeout=None):
+        """The return value of the call, waiting for it up to timeout 
+        seconds; raises what the call raised."""
+        if self.exception(timeout) is not None:
+            raise self._exception
+        return self._result
+        
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("DB: call not done after %s s" % (timeout,))
+        return self._exception
+        
+    def add_done_callback(self, fn):
+        """Call fn(future) once the call is done, from the database thread
+        (right away if it is done already). Qt callers can pass a Signal's
+        emit to get it queued to the GUI thread."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+        
+    def _set(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception("DB: Callback of %r failed" % (fn,))
+
+
+class AsyncModel(object):
+    def __init__(self, model, readers=ASYNC_READERS):
+        """Run the calls of a Model off the calling thread, so that a GUI
+        or event loop never waits for SQLite. Every method returns a 
+        DatabaseFuture at once.
+        The ASYNC_WRITE_METHODS run on one writer thread, in the order 
+        they were called. The ASYNC_READ_METHODS and the AsyncView methods
+        run on a pool of reader threads; a read waits for the writes 
+        called before it, so it sees them.
+        """
+        self.model = model
+        self._writes = Queue.Queue()
+        self._reads = Queue.Queue()
+        # writes called and finished, for reads to wait on
+        self._writes_called = 0
+        self._writes_finished = 0
+        self._writes_condition = threading.Condition()
+        
+        self._threads = [threading.Thread(target=self._work, 
+                                          args=(self._writes, True),
+                                          name="database_writer")]
+        for i in range(readers):
+            self._threads.append(threading.Thread(target=self._work, 
+                                                  args=(self._reads, False),
+                                                  name="database_reader"))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
             
-        with sqlite3.connect(**self.model.connect_args) as conn:
-            # Find all valid folders that file_extensions were moved to
-            rows = conn.execute("""SELECT folder_path, flag_explorer_open 
-                    FROM target_folder WHERE  
-                    flag_retired=? AND flag_private IN (?,?) AND
-                    folder_path IN (SELECT DISTINCT target_folder 
-                                    FROM move_latest WHERE  
-                                    file_extension=? AND filename_length=?)""",
-                    (False, False, private_include, file_extension_db, fn_len)).fetchall()
-            #print rows, fn_len
-            for row in rows:
-                # For each folder, get additional data
-                moved_times = conn.execute("""SELECT SUM(moved_times) 
-                    FROM move_latest WHERE target_folder=? AND 
-                    file_extension=? AND filename_length=?""",(row[0],file_extension_db,fn_len)).fetchone()[0]
-                if not moved_times:
-                    moved_times = 0
-                timestamp_str = conn.execute("""SELECT MAX(moved_latest_date) 
-                    FROM move_latest WHERE target_folder=? AND
-                    file_extension=? AND filename_length=?""",(row[0],file_extension_db,fn_len)).fetchone()[0]
-                if timestamp_str:
-                    timestamp = datetime.datetime.strptime(
-                            timestamp_str, "%Y-%m-%d %H:%M:%S.%f")
-                    moved_latest_date_str = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                else:
-                    moved_latest_date_str = ''
-                
-                yield(str(moved_times), row[0], moved_latest_date_str, 
-                      self.str_from_boolean(row[1]))    
-    
-   
+        for name in ASYNC_WRITE_METHODS:
+            setattr(self, name, self._caller(getattr(model, name), True))
+        for name in ASYNC_READ_METHODS:
+            setattr(self, name, self._caller(getattr(model, name), False))
+            
+    def _caller(self, method, write):
+        def call(*args, **kwargs):
+            return self.submit(method, args, kwargs, write)
+        call.__name__ = method.__name__
+        call.__doc__ = method.__doc__
+        return call
+        
+    def submit(self, function, args=(), kwargs=None, write=False):
+        """Run function(*args, **kwargs) on the writer thread or a reader
+        thread, return its DatabaseFuture."""
+        future = DatabaseFuture()
+        kwargs = kwargs or {}
+        with self._writes_condition:
+            if write:
+                self._writes_called += 1
+                self._writes.put((None, future, function, args, kwargs))
+            else:
+                self._reads.put((self._writes_called, future, function, 
+                                 args, kwargs))
+        return future
+        
+    def _work(self, tasks, write):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            writes_before, future, function, args, kwargs = task
+            if writes_before:
+                with self._writes_condition:
+                    while self._writes_finished < writes_before:
+                        self._writes_condition.wait()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                future._set(exception=e)
+            else:
+                future._set(result)
+            finally:
+                if write:
+                    with self._writes_condition:
+                        self._writes_finished += 1
+                        self._writes_condition.notify_all()
+        self.model._connection_release()
+        
+    def close(self):
+        """Finish the calls made so far, stop the threads and close the
+        model. Blocks."""
+        self._writes.put(None)
+        for thread in self._threads[1:]:
+            self._reads.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.model.close()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class AsyncView(object):
+    def __init__(self, async_model):
+        """The View of an AsyncModel's model, its ASYNC_VIEW_METHODS run on
+        the reader threads. The generators are run to the end there: their
+        future's result is the list of rows. Pass on_rows=callable to get 
+        the rows as they come, VIEW_FETCH_BATCH at a time, from the reader 
+        thread.
+        """
+        self.async_model = async_model
+        self.view = View(async_model.model)
+        for name in ASYNC_VIEW_METHODS:
+            setattr(self, name, self._caller(getattr(self.view, name)))
+            
+    def _caller(self, method):
+        def call(*args, **kwargs):
+            on_rows = kwargs.pop('on_rows', None)
+            return self.async_model.submit(self._rows_collect, 
+                                           (method, args, kwargs, on_rows))
+        call.__name__ = method.__name__
+        call.__doc__ = method.__doc__
+        return call
+        
+    def _rows_collect(self, method, args, kwargs, on_rows):
+        rows = []
+        batch = []
+        for row in method(*args, **kwargs):
+            rows.append(row)
+            if on_rows is not None:
+                batch.append(row)
+                if len(batch) == VIEW_FETCH_BATCH:
+                    on_rows(batch)
+                    batch = []
+        if batch:
+            on_rows(batch)
+        return rows
+        
+        
 def test_bookmark_add():
+    from PySide import QtCore, QtGui
     app = QtGui.QApplication(sys.argv)
     folder_selected = QtGui.QFileDialog.getExistingDirectory(
             caption="Select your Downloads folder!",dir=QtCore.QDir.homePath())
@@ -402,8 +2248,9 @@ def test_bookmark_add():
     app.quit()
     print("Adding bookmark: DONE")
     
-def test_view_bookmarks():
-    model = Model()
+def test_view_bookmarks(model=None):
+    if model is None:
+        model = Model()
     view = View(model)
     
     filename = 'test.pdf'
@@ -419,8 +2266,9 @@ def test_view_bookmarks():
         print ll
     print("Generating view with bookmarks: DONE")
     
-def test_by_extension_generate():
-    model = Model()
+def test_by_extension_generate(model=None):
+    if model is None:
+        model = Model()
     view = View(model)
     
     filename = 'test.tt'
@@ -437,8 +2285,9 @@ def test_by_extension_generate():
 
    
    
-def test_view_generate_class():
-    model = Model()
+def test_view_generate_class(model=None):
+    if model is None:
+        model = Model()
     view = View(model)
     
     filename = 'test.txt'
@@ -475,8 +2324,9 @@ def test_view_generate_class():
         print ll
     print("Generating view with all: DONE")
     
-def test_model():
-    model = Model()
+def test_model(model=None):
+    if model is None:
+        model = Model()
     print model.bookmark_add("test")
     #print model.bookmark_add("test")
     print model.bookmark_add("test2")
@@ -496,9 +2346,11 @@ def test_model():
 
    
 if __name__ == "__main__": 
+    # a fresh database in memory, leaves loadstar_sqlite3.db alone
+    model = Model(None, memory=True)
     #test_bookmark_add()
-    test_model()
-    #test_by_extension_generate()
-    test_view_generate_class()
+    test_model(model)
+    #test_by_extension_generate(model)
+    test_view_generate_class(model)
     
     